@@ -0,0 +1,310 @@
+# -*- coding: utf-8 -*-
+""" Benchmarks of the jsrt.py hot paths on synthetic JSRT images.
+
+The JSRT images can not be shipped, so this script writes synthetic 2048x2048 big endian 16 bit .IMG files along with
+matching Clinical_Information/CLNDAT_EN.txt and CNNDAT_EN.TXT files into a temporary directory. Each benchmark runs in
+its own process, so that its peak memory (max RSS) is measured on its own, and the results are written as JSON.
+peak_rss_mb is how much the timed runs raised the peak above the one reached while setting the benchmark up
+(setup_rss_mb), so it is 0 when the runs stay below the setup peak. children_rss_mb is the largest peak of the
+processes the runs started (such as the augment_images pool), and peak_rss_mb is raised to it when it is larger.
+
+Examples:
+    python benchmark.py --sizes 8 32 --workers 1 4 --output bench_output.txt
+    python benchmark.py --output new.json --compare bench_output.txt --tolerance 0.2
+
+"""
+import argparse
+import json
+import platform
+import resource
+import shutil
+import sys
+import tempfile
+import time
+from multiprocessing import Process, Queue
+from Queue import Empty
+from os import chdir, makedirs, symlink
+from os.path import abspath, dirname, join
+
+import numpy as np
+
+sys.path.insert(0, dirname(abspath(__file__)))
+from jsrt import Jsrt, JsrtImage, JsrtPipeline  # noqa: E402
+
+IMAGE_SIDE = 2048
+
+
+def write_fixtures(root, count, seed=0):
+    """ This function writes `count` synthetic images (half with nodules) in root/images/ and their descriptions in
+    root/Clinical_Information/.
+
+    Args:
+        root  (str): Directory to write to.
+        count (int): Number of images.
+        seed  (int): Defaults to 0. Seed of the random number generator.
+
+    Returns:
+        filenames (list): names of the image files, has-nodule and non-nodule images alternating.
+
+    """
+    rng = np.random.RandomState(seed)
+    makedirs(join(root, "images"))
+    makedirs(join(root, "Clinical_Information"))
+    filenames = []
+    with open(join(root, "Clinical_Information", "CLNDAT_EN.txt"), "w") as nodule_csv, \
+            open(join(root, "Clinical_Information", "CNNDAT_EN.TXT"), "w") as non_nodule_csv:
+        for index in range(count):
+            if index % 2 == 0:
+                filename = "JPCLN%03d.IMG" % (index // 2 + 1)
+                nodule_csv.write("\t".join([filename, str(rng.randint(1, 6)), str(rng.randint(5, 40)),
+                                            str(rng.randint(20, 90)), "male" if rng.rand() < 0.5 else "female",
+                                            str(rng.randint(200, 1848)), str(rng.randint(200, 1848)), "malignant",
+                                            "l." if rng.rand() < 0.5 else "r.", "upper lobe", "lung cancer"]) + "\n")
+            else:
+                filename = "JPCNN%03d.IMG" % (index // 2 + 1)
+                non_nodule_csv.write(" ".join([filename, str(rng.randint(20, 90)), "",
+                                               "male" if rng.rand() < 0.5 else "female", "", "non-nodule"]) + "\n")
+            rng.randint(0, 4096, size=(IMAGE_SIDE, IMAGE_SIDE)).astype(">i2").tofile(join(root, "images", filename))
+            filenames.append(filename)
+    return filenames
+
+
+def image_directory(root, filenames, size):
+    """ Gives a directory (relative to root) holding links to the first `size` images. """
+    directory = "images_%d" % size
+    makedirs(join(root, directory))
+    for filename in filenames[:size]:
+        symlink(join(root, "images", filename), join(root, directory, filename))
+    return "./" + directory + "/"
+
+
+def _loaded(directory, lazy=True):
+    return Jsrt().load_images(directory, lazy=lazy)
+
+
+def _all_images(jsrt):
+    return jsrt._has_nodule_image_list + jsrt._non_nodule_image_list
+
+
+# Each benchmark takes (image directory, number of images, workers, temporary directory) and gives the function to
+# time and the number of images it processes. Work done before returning is not timed.
+def bench_load_images(directory, size, workers, scratch):
+    return lambda: Jsrt().load_images(directory, workers=workers), size
+
+
+def bench_load_images_lazy(directory, size, workers, scratch):
+    return lambda: Jsrt().load_images(directory, lazy=True, workers=workers), size
+
+
+def bench_horizontal_reflection(directory, size, workers, scratch):
+    images = _all_images(_loaded(directory, lazy=False))
+    return lambda: [image.new_child().horizontal_reflection() for image in images], size
+
+
+def bench_rotate(directory, size, workers, scratch):
+    images = _all_images(_loaded(directory, lazy=False))
+    return lambda: [image.new_child().rotate(2) for image in images], size
+
+
+def bench_rotate_bilinear(directory, size, workers, scratch):
+    images = _all_images(_loaded(directory, lazy=False))
+    return lambda: [image.new_child().rotate(2, order=1) for image in images], size
+
+
+def bench_rotate_image(directory, size, workers, scratch):
+    images = _all_images(_loaded(directory, lazy=False))
+    return lambda: Jsrt.rotate_image(images, [2]), size
+
+
+def bench_rotate_image_bilinear(directory, size, workers, scratch):
+    images = _all_images(_loaded(directory, lazy=False))
+    return lambda: Jsrt.rotate_image(images, [2], order=1), size
+
+
+def bench_crop(directory, size, workers, scratch):
+    images = _all_images(_loaded(directory, lazy=False))
+    return lambda: [image.crop(299, 1024, 1024) for image in images], size
+
+
+def bench_down_sample(directory, size, workers, scratch):
+    images = _all_images(_loaded(directory, lazy=False))
+    return lambda: [image.down_sample(299 / 2048.) for image in images], size
+
+
+def bench_augment_images(directory, size, workers, scratch):
+    def run():
+        jsrt = _loaded(directory, lazy=True)
+        jsrt.augment_images(rotate_angles=[1, 2], processes=workers)
+    # Each image gives a reflection and two rotations of both.
+    return run, size * 5
+
+
+def bench_save_images(directory, size, workers, scratch):
+    images = _all_images(_loaded(directory, lazy=False))
+    return lambda: Jsrt.save_images(images, join(scratch, "save.tfrecords"), workers=workers), size
+
+
+def bench_read_images(directory, size, workers, scratch):
+    filename = join(scratch, "read.tfrecords")
+    Jsrt.save_images(_all_images(_loaded(directory, lazy=True)), filename)
+    return lambda: Jsrt.read_images(filename), size
+
+
+def bench_pipeline(directory, size, workers, scratch):
+    filenames = [join(directory, image.image_path.split("/")[-1]) for image in _all_images(_loaded(directory))]
+    pipeline = JsrtPipeline([("read", lambda filename: JsrtImage().load_from_file(filename), workers),
+                             ("transform", lambda image: image.new_child().rotate(2, order=1), workers)])
+    return lambda: Jsrt.save_images(pipeline.run(filenames), join(scratch, "pipeline.jsrt"), file_format="native"), size
+
+
+# name: (benchmark, whether it uses workers, whether it needs tensorflow)
+BENCHMARKS = [
+    ("load_images", bench_load_images, True, False),
+    ("load_images_lazy", bench_load_images_lazy, True, False),
+    ("horizontal_reflection", bench_horizontal_reflection, False, False),
+    ("rotate", bench_rotate, False, False),
+    ("rotate_bilinear", bench_rotate_bilinear, False, False),
+    ("rotate_image", bench_rotate_image, False, False),
+    ("rotate_image_bilinear", bench_rotate_image_bilinear, False, False),
+    ("crop", bench_crop, False, False),
+    ("down_sample", bench_down_sample, False, False),
+    ("augment_images", bench_augment_images, True, False),
+    ("save_images", bench_save_images, True, True),
+    ("read_images", bench_read_images, False, True),
+    ("pipeline", bench_pipeline, True, False),
+]
+
+
+def _run_case(benchmark, root, directory, size, workers, repeats, results):
+    """ Runs one benchmark in the current (child) process and puts its result in the `results` queue. """
+    try:
+        chdir(root)
+        scratch = tempfile.mkdtemp(dir=root)
+        function, images = benchmark(directory, size, workers, scratch)
+        # ru_maxrss is in kilobytes on Linux.
+        setup_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        timings = []
+        for _ in range(repeats):
+            start = time.time()
+            function()
+            timings.append(time.time() - start)
+        # The worker processes of the runs have been joined, so their peaks are in RUSAGE_CHILDREN.
+        peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - setup_rss
+        children_rss = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+        results.put({"seconds": min(timings), "mean_seconds": float(np.mean(timings)),
+                     "images_per_second": images / min(timings) if min(timings) > 0 else None,
+                     "setup_rss_mb": setup_rss / 1024.0, "children_rss_mb": children_rss / 1024.0,
+                     "peak_rss_mb": max(peak_rss, children_rss) / 1024.0})
+    except Exception as error:
+        results.put({"error": repr(error)})
+
+
+def _wait_for_result(process, queue, poll_seconds=1.0):
+    """ Gives the result the benchmark process puts in queue, or an error when the process exits without one (for
+    example when it is killed for running out of memory). """
+    while True:
+        try:
+            return queue.get(timeout=poll_seconds)
+        except Empty:
+            if not process.is_alive():
+                break
+    # The process may have put its result just before exiting.
+    try:
+        return queue.get(timeout=poll_seconds)
+    except Empty:
+        return {"error": "the benchmark process exited with code %s" % process.exitcode}
+
+
+def run_benchmarks(sizes, workers_list, repeats, names=None):
+    """ This function runs the benchmarks for every dataset size and worker count.
+
+    Args:
+        sizes        (list): Numbers of images.
+        workers_list (list): Worker counts, used by the benchmarks that have workers.
+        repeats       (int): Number of times each benchmark is timed, the fastest time is reported.
+        names        (list): Defaults to None. Names of the benchmarks to run, None runs all of them.
+
+    Returns:
+        results (list): A dict for each benchmark run.
+
+    """
+    try:
+        import tensorflow  # noqa: F401
+        has_tensorflow = True
+    except ImportError:
+        has_tensorflow = False
+
+    root = tempfile.mkdtemp(prefix="jsrt_benchmark_")
+    results = []
+    try:
+        filenames = write_fixtures(root, max(sizes))
+        for size in sizes:
+            directory = image_directory(root, filenames, size)
+            for name, benchmark, uses_workers, needs_tensorflow in BENCHMARKS:
+                if names and name not in names:
+                    continue
+                for workers in (workers_list if uses_workers else [1]):
+                    result = {"benchmark": name, "images": size, "workers": workers, "repeats": repeats}
+                    if needs_tensorflow and not has_tensorflow:
+                        result["skipped"] = "tensorflow is not installed"
+                    else:
+                        queue = Queue()
+                        process = Process(target=_run_case,
+                                          args=(benchmark, root, directory, size, workers, repeats, queue))
+                        process.start()
+                        result.update(_wait_for_result(process, queue))
+                        process.join()
+                    results.append(result)
+                    sys.stderr.write(json.dumps(result, sort_keys=True) + "\n")
+    finally:
+        shutil.rmtree(root)
+    return results
+
+
+def compare(results, baseline, tolerance):
+    """ Gives the benchmarks of results that are slower than in baseline by more than tolerance (0.2 is 20%). """
+    baseline_seconds = dict(((result["benchmark"], result["images"], result["workers"]), result["seconds"])
+                            for result in baseline if "seconds" in result)
+    slower = []
+    for result in results:
+        key = (result["benchmark"], result["images"], result["workers"])
+        if "seconds" in result and key in baseline_seconds and \
+                result["seconds"] > baseline_seconds[key] * (1 + tolerance):
+            slower.append(dict(result, baseline_seconds=baseline_seconds[key]))
+    return slower
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("--sizes", type=int, nargs="+", default=[4, 16], help="numbers of images")
+    parser.add_argument("--workers", type=int, nargs="+", default=[1, 4], help="worker counts")
+    parser.add_argument("--repeats", type=int, default=3, help="timings per benchmark, the fastest is reported")
+    parser.add_argument("--benchmarks", nargs="+", default=None,
+                        help="benchmarks to run: " + ", ".join(name for name, _, _, _ in BENCHMARKS))
+    parser.add_argument("--output", default=None, help="JSON file to write the results to (default: stdout)")
+    parser.add_argument("--compare", default=None, help="JSON results of an earlier run to compare with")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="allowed slowdown when comparing (0.2 is 20%%)")
+    args = parser.parse_args()
+
+    report = {"python": platform.python_version(), "numpy": np.__version__, "platform": platform.platform(),
+              "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+              "results": run_benchmarks(args.sizes, args.workers, args.repeats, args.benchmarks)}
+    if args.output is None:
+        print json.dumps(report, indent=2, sort_keys=True)
+    else:
+        with open(args.output, "w") as output:
+            json.dump(report, output, indent=2, sort_keys=True)
+
+    if args.compare is not None:
+        with open(args.compare) as baseline:
+            slower = compare(report["results"], json.load(baseline)["results"], args.tolerance)
+        for result in slower:
+            sys.stderr.write("SLOWER: %s images=%d workers=%d %.3fs (was %.3fs)\n" % (
+                result["benchmark"], result["images"], result["workers"], result["seconds"],
+                result["baseline_seconds"]))
+        if slower:
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,13 +1,444 @@
 # -*- coding: utf-8 -*-
+# tensorflow and matplotlib are imported only in the functions that use them, as they are slow to import and not
+# needed to load and transform images.
 import numpy as np
 from scipy import ndimage
-import matplotlib.pyplot as plt
-import matplotlib.cm as cm
+from collections import OrderedDict, namedtuple
 from csv import reader, excel_tab
-from os import listdir
-import tensorflow as tf
-import copy
+from os import close, listdir, makedirs, remove, rename, stat, utime
+from os.path import abspath, exists, getsize, join
+from multiprocessing import Pool
+from multiprocessing.pool import ThreadPool
+from tempfile import mkdtemp, mkstemp
+from zipfile import BadZipfile
+from threading import Event, Thread
+from Queue import Empty, Full, Queue
+import cProfile
+import hashlib
+import logging
 import math
+import mmap
+import pstats
+import shutil
+import struct
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+logger.addHandler(logging.NullHandler())
+
+
+def _augment_worker(job):
+    """ Process pool worker of Jsrt.augment_images. The source image is opened as a read-only np.memmap, so it is
+    shared through the page cache instead of being pickled to every worker.
+
+    Args:
+        job (tuple): (filename, dtype, shape, offset, reflect, degrees, order) where reflect (bool) asks for a
+                     horizontal reflection and degrees (float or None) for a rotation done after it.
+
+    Returns:
+        image (array): The transformed image.
+
+    """
+    filename, dtype, shape, offset, reflect, degrees, order = job
+    image = np.memmap(filename, dtype=dtype, mode="r", shape=shape, offset=offset)
+    if reflect is True:
+        image = np.fliplr(image)
+    if degrees is not None:
+        off, mat = JsrtImage.get_rotation_matrix(shape, degrees)
+        image = ndimage.affine_transform(image, mat, off, order=order, mode="nearest")
+    else:
+        image = np.array(image)
+    return image
+
+
+def _area_weights(in_size, out_size):
+    """ Gives the (out_size, in_size) matrix whose row i averages the input pixels covered by output pixel i, each
+    weighted by the fraction of it that is covered. """
+    edges = np.arange(out_size + 1) * float(in_size) / out_size
+    pixels = np.arange(in_size)
+    overlap = np.minimum(edges[1:, np.newaxis], pixels + 1) - np.maximum(edges[:-1, np.newaxis], pixels)
+    return np.clip(overlap, 0, None) / (edges[1:] - edges[:-1])[:, np.newaxis]
+
+
+def _area_average(image, shape):
+    """ This function down samples image to shape by area averaging. When shape divides the image shape, it is the
+    mean of equal blocks, otherwise pixels partly covered by a new pixel count by the covered fraction.
+
+    Args:
+        image (array): A 2D image.
+        shape (tuple): (height, width) of the new image.
+
+    Returns:
+        new_image (array): The averaged image, rounded to the (native byte order) dtype of image.
+
+    """
+    height, width = image.shape
+    new_height, new_width = shape
+    if height % new_height == 0 and width % new_width == 0:
+        new_image = image.reshape((new_height, height // new_height, new_width, width // new_width)).mean(axis=(1, 3))
+    else:
+        new_image = np.dot(np.dot(_area_weights(height, new_height), image), _area_weights(width, new_width).T)
+    dtype = image.dtype.newbyteorder("=")
+    if dtype.kind in "iu":
+        new_image = np.rint(new_image)
+    return new_image.astype(dtype)
+
+
+def _spline_weights(order, t):
+    """ Gives the (len(t), order + 1) B-spline weights of the taps around each coordinate, t being the distance of the
+    coordinate from its first (order 1, 3) or nearest (order 0) tap. """
+    weights = np.empty((len(t), order + 1))
+    if order == 0:
+        weights[:, 0] = 1
+    elif order == 1:
+        weights[:, 0] = 1 - t
+        weights[:, 1] = t
+    else:
+        s = 1 - t
+        t2 = t * t
+        t3 = t2 * t
+        weights[:, 0] = s * s * s / 6.
+        weights[:, 1] = (4 - 6 * t2 + 3 * t3) / 6.
+        weights[:, 2] = (1 + 3 * t + 3 * t2 - 3 * t3) / 6.
+        weights[:, 3] = t3 / 6.
+    return weights
+
+
+def _resampling_operator(shape, matrix, offset, order, first_row, last_row):
+    """ This function gives the sparse matrix that computes the output rows first_row to last_row of
+    ndimage.affine_transform(image, matrix, offset, order=order, mode="nearest") from the spline coefficients of the
+    image, padded by one pixel before and two after on both axes (see _resample_stack). Each output pixel is a row
+    holding the (order + 1) ** 2 weights of its taps, so the matrix is computed once and applied to any number of
+    images with a single sparse product. The weights are float64, so the results only differ from ndimage in the last
+    bits, and integer images get the same pixels.
+
+    Args:
+        shape     (tuple): (height, width) of the images.
+        matrix    (array): 2x2 matrix mapping the output coordinates to the input coordinates.
+        offset    (array): Offset of the mapping.
+        order       (int): The order of the spline interpolation, 0, 1 or 3.
+        first_row   (int): First output row.
+        last_row    (int): Output row after the last one.
+
+    Returns:
+        operator (scipy.sparse.csr_matrix): Matrix of shape ((last_row - first_row) * width,
+                                            (height + 3) * (width + 3)).
+
+    """
+    from scipy import sparse
+
+    height, width = shape
+    padded_width = width + 3
+    rows = np.arange(first_row, last_row, dtype=np.float64)[:, np.newaxis]
+    columns = np.arange(width, dtype=np.float64)[np.newaxis, :]
+    c0 = np.clip(matrix[0, 0] * rows + matrix[0, 1] * columns + offset[0], 0, height - 1).ravel()
+    c1 = np.clip(matrix[1, 0] * rows + matrix[1, 1] * columns + offset[1], 0, width - 1).ravel()
+    if order == 0:
+        f0 = np.floor(c0 + 0.5)
+        f1 = np.floor(c1 + 0.5)
+    else:
+        f0 = np.floor(c0)
+        f1 = np.floor(c1)
+    taps = order + 1
+    # index of the first tap in the padded coefficients, the padding adds 1 to both axes
+    first = 1 - (order - 1) // 2 if order > 0 else 1
+    base = (f0.astype(np.int32) + first) * padded_width + f1.astype(np.int32) + first
+    tap_offsets = (np.arange(taps)[:, np.newaxis] * padded_width + np.arange(taps)).ravel().astype(np.int32)
+    w0 = _spline_weights(order, c0 - f0)
+    w1 = _spline_weights(order, c1 - f1)
+    indices = (base[:, np.newaxis] + tap_offsets).ravel()
+    data = (w0[:, :, np.newaxis] * w1[:, np.newaxis, :]).ravel()
+    indptr = np.arange(0, taps * taps * len(base) + 1, taps * taps, dtype=np.int32)
+    return sparse.csr_matrix((data, indices, indptr), shape=(len(base), (height + 3) * padded_width))
+
+
+def _resample_stack(images, transforms, order, out, block_rows=256):
+    """ This function is the batch engine of Jsrt.rotate_stack and Jsrt.rotate_image. For order 0, 1 and 3 it gives
+    the same pixels as calling ndimage.affine_transform(image, matrix, offset, order=order, mode="nearest") on every
+    image, but the coordinates, taps and weights of a transform are computed once (as a sparse matrix, by blocks of
+    block_rows output rows) and applied to the whole stack, and the cubic spline prefilter is done once for all the
+    transforms.
+
+    Args:
+        images (array): An array of shape (N, height, width).
+        transforms (list): A list of (offset, matrix) pairs, as given by JsrtImage.get_rotation_matrix.
+        order (int): The order of the spline interpolation, 0, 1 or 3.
+        out (array): Array of shape (len(transforms), N, height, width) that receives the results. Integer results
+                     are rounded as ndimage does (half away from zero) and clipped to the range of the dtype.
+        block_rows (int): Defaults to 256. Output rows computed with one sparse matrix.
+
+    Returns:
+        out (array): The results.
+
+    """
+    n, height, width = images.shape
+    coefficients = np.empty((height + 3, width + 3, n), dtype=np.float64)
+    interior = coefficients[1:height + 1, 1:width + 1]
+    interior[...] = images.transpose(1, 2, 0)
+    if order > 1:
+        for axis in (0, 1):
+            ndimage.spline_filter1d(interior, order, axis=axis, output=interior)
+    # mirror padding, the boundary ndimage uses for the spline taps past the edges
+    coefficients[0] = coefficients[2]
+    coefficients[height + 1] = coefficients[height - 1]
+    coefficients[height + 2] = coefficients[height - 2]
+    coefficients[:, 0] = coefficients[:, 2]
+    coefficients[:, width + 1] = coefficients[:, width - 1]
+    coefficients[:, width + 2] = coefficients[:, width - 2]
+    coefficients = coefficients.reshape((-1, n))
+
+    dtype = out.dtype
+    for i, (offset, matrix) in enumerate(transforms):
+        for first_row in range(0, height, block_rows):
+            last_row = min(first_row + block_rows, height)
+            operator = _resampling_operator((height, width), matrix, offset, order, first_row, last_row)
+            block = operator.dot(coefficients)
+            if dtype.kind == "u":
+                np.clip(block, 0, np.iinfo(dtype).max, out=block)
+                block += 0.5
+                np.floor(block, out=block)
+            elif dtype.kind == "i":
+                block = np.where(block < 0, np.ceil(block - 0.5), np.floor(block + 0.5))
+                np.clip(block, np.iinfo(dtype).min, np.iinfo(dtype).max, out=block)
+            out[i, :, first_row:last_row] = block.T.reshape((n, last_row - first_row, width))
+    return out
+
+
+def pack_12bit(image, clip=False):
+    """ This function packs 12 bit pixels (0 to 4095, such as the JSRT images) two in three bytes, which takes 25% less
+    memory and disk space than 16 bit pixels. Pixel 2i is in the low 12 bits and pixel 2i + 1 in the high 12 bits of
+    bytes 3i to 3i + 2 (little endian). An odd number of pixels is padded with a 0 pixel.
+
+    See Also: unpack_12bit
+
+    Args:
+        image (array): An array of integer pixels, of any shape.
+        clip   (bool): Defaults to False. When True values outside 0 to 4095 (such as the overshoot of a cubic spline
+                       rotation) are clipped into it, otherwise they raise a ValueError.
+
+    Returns:
+        packed (array): uint8 array of (image.size + 1) // 2 * 3 bytes.
+
+    """
+    flat = np.asarray(image).ravel()
+    if clip is True:
+        flat = np.clip(flat, 0, 4095)
+    elif flat.size and (flat.min() < 0 or flat.max() > 4095):
+        raise ValueError("pack_12bit: pixel values must be between 0 and 4095")
+    flat = flat.astype(np.uint16)
+    if flat.size % 2:
+        flat = np.concatenate([flat, np.zeros(1, dtype=np.uint16)])
+    first = flat[0::2]
+    second = flat[1::2]
+    packed = np.empty((flat.size // 2, 3), dtype=np.uint8)
+    packed[:, 0] = first & 0xFF
+    packed[:, 1] = (first >> 8) | ((second & 0xF) << 4)
+    packed[:, 2] = second >> 4
+    return packed.ravel()
+
+
+def unpack_12bit(packed, shape):
+    """ This function unpacks the pixels packed by pack_12bit into a native uint16 array of `shape`. """
+    packed = np.asarray(packed, dtype=np.uint8).reshape((-1, 3)).astype(np.uint16)
+    image = np.empty((len(packed), 2), dtype=np.uint16)
+    image[:, 0] = packed[:, 0] | ((packed[:, 1] & 0xF) << 8)
+    image[:, 1] = (packed[:, 1] >> 4) | (packed[:, 2] << 4)
+    return image.ravel()[:int(np.prod(shape))].reshape(shape)
+
+
+def _prefetch(items, size):
+    """ This function iterates over `items` in a background thread that keeps up to `size` items ready in a bounded
+    queue. Errors raised while producing the items are raised again in the consumer.
+
+    Args:
+        items (iterable): The items to iterate over, such as a generator doing I/O.
+        size       (int): Maximum number of items waiting in the queue.
+
+    Yields:
+        The items of `items`, in order.
+
+    """
+    queue = Queue(maxsize=max(1, size))
+    stop = Event()
+    done = object()
+
+    def _put(item):
+        while not stop.is_set():
+            try:
+                queue.put(item, timeout=0.1)
+                return
+            except Full:
+                pass
+
+    def _produce():
+        try:
+            for item in items:
+                _put((item, None))
+                if stop.is_set():
+                    return
+            _put((done, None))
+        except Exception as error:
+            _put((done, error))
+
+    thread = Thread(target=_produce)
+    thread.daemon = True
+    thread.start()
+    try:
+        while True:
+            item, error = queue.get()
+            if item is done:
+                if error is not None:
+                    raise error
+                return
+            yield item
+    finally:
+        stop.set()
+
+
+# JsrtMetrics objects currently recording, see JsrtMetrics.__enter__.
+_active_metrics = []
+_profiling = threading.local()
+
+
+class _Stage(object):
+    """ Times one run of a named stage and reports it to the active JsrtMetrics objects. The number of bytes read or
+    written can be set on it inside the with block when it is only known then. """
+    __slots__ = ("name", "nbytes", "_start", "_profiler")
+
+    def __init__(self, name, nbytes=0):
+        self.name = name
+        self.nbytes = nbytes
+        self._start = None
+        self._profiler = None
+
+    def __enter__(self):
+        # Only one profiler can run at a time in a thread, so stages inside a profiled stage are not profiled again.
+        if not getattr(_profiling, "active", False) and \
+                any(self.name in metrics.profile_stages for metrics in _active_metrics):
+            _profiling.active = True
+            self._profiler = cProfile.Profile()
+            self._profiler.enable()
+        self._start = time.time()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        seconds = time.time() - self._start
+        if self._profiler is not None:
+            self._profiler.disable()
+            _profiling.active = False
+        for metrics in list(_active_metrics):
+            metrics.record(self.name, seconds, self.nbytes, self._profiler)
+        return False
+
+
+class _NoStage(object):
+    """ Stand-in for _Stage when nothing is recording, so that the hot paths only pay for a list check. """
+    __slots__ = ("nbytes",)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        return False
+
+
+def _stage(name, nbytes=0):
+    """ Gives a context manager timing the stage `name` when a JsrtMetrics object is recording. """
+    if not _active_metrics:
+        return _NoStage()
+    return _Stage(name, nbytes)
+
+
+class JsrtMetrics(object):
+    """ JsrtMetrics records what the hot paths of this module do while it is active (inside its with block): for every
+    stage the number of runs, their latencies and the bytes read or written. The stages are "load",
+    "horizontal_reflection", "rotate", "rotate_stack", "transform", "crop", "crop_batch", "down_sample",
+    "tfrecord_write", "tfrecord_read", "native_write", "spill_write", "load_images" and "augment_images", and the
+    stages of a JsrtPipeline by their names.
+
+    Args:
+        callbacks      (list): Defaults to (). Functions called as callback(stage, seconds, nbytes) after every run
+                               of a stage, for example to drive a progress bar.
+        profile_stages (list): Defaults to (). Names of stages to run under cProfile. Their profiles are gathered
+                               in `profiles`, a dict of stage name to pstats.Stats.
+
+    Examples:
+        with JsrtMetrics(profile_stages=["rotate_stack"]) as metrics:
+            jsrtdata.augment_images(rotate_angles=[1, 2])
+        print metrics.summary()["rotate_stack"]["p90_seconds"]
+        metrics.profiles["rotate_stack"].sort_stats("cumulative").print_stats(10)
+
+    """
+    def __init__(self, callbacks=(), profile_stages=()):
+        self.callbacks = list(callbacks)
+        self.profile_stages = set(profile_stages)
+        self.profiles = {}
+        self._latencies = {}
+        self._bytes = {}
+        self._lock = threading.Lock()
+
+    def __enter__(self):
+        _active_metrics.append(self)
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        _active_metrics.remove(self)
+        return False
+
+    def record(self, stage, seconds, nbytes=0, profiler=None):
+        """ Records a run of `stage` that took `seconds` and read or wrote `nbytes`. """
+        with self._lock:
+            self._latencies.setdefault(stage, []).append(seconds)
+            self._bytes[stage] = self._bytes.get(stage, 0) + nbytes
+            if profiler is not None:
+                if stage in self.profiles:
+                    self.profiles[stage].add(profiler)
+                else:
+                    self.profiles[stage] = pstats.Stats(profiler)
+        for callback in self.callbacks:
+            callback(stage, seconds, nbytes)
+
+    def count(self, stage):
+        """ Gives the number of runs of `stage` recorded. """
+        return len(self._latencies.get(stage, []))
+
+    def summary(self):
+        """ This function gives the recorded figures of every stage.
+
+        Returns:
+            summary (dict): stage name -> dict of count, total_seconds, mean_seconds, p50_seconds, p90_seconds,
+                            p99_seconds, max_seconds and bytes.
+
+        """
+        summary = {}
+        with self._lock:
+            for stage, latencies in self._latencies.items():
+                latencies = np.array(latencies)
+                summary[stage] = {"count": len(latencies), "total_seconds": float(latencies.sum()),
+                                  "mean_seconds": float(latencies.mean()),
+                                  "p50_seconds": float(np.percentile(latencies, 50)),
+                                  "p90_seconds": float(np.percentile(latencies, 90)),
+                                  "p99_seconds": float(np.percentile(latencies, 99)),
+                                  "max_seconds": float(latencies.max()), "bytes": self._bytes[stage]}
+        return summary
+
+
+# Clinical details of an image that no transform changes. Augmented images share the JsrtDescription of the image
+# they were made from.
+JsrtDescription = namedtuple("JsrtDescription", ["degree_of_subtlety", "nodule_size", "age", "sex",
+                                                 "malignant_or_benign", "diagnosis"])
+
+
+def _description_property(field):
+    """ Gives a property reading `field` of the JsrtDescription of a JsrtImage. Setting it gives the JsrtImage its own
+    updated JsrtDescription, leaving the one shared with other images unchanged. """
+    def _get(self):
+        return getattr(self._description, field)
+
+    def _set(self, value):
+        self._description = self._description._replace(**{field: value})
+    return property(_get, _set)
 
 
 class JsrtImage(object):
@@ -15,22 +446,58 @@ class JsrtImage(object):
     filename, nodule size [mm], degree of subtlety, x and y coordinates of the nodule location, age, sex, malignant
     or benign, anatomic location, and diagnosis.
 
+    JsrtImage uses __slots__ to stay small, as augmentation creates thousands of them. An augmented image only holds
+    its own image, coordinates, position and transforms, a reference to the image it was made from (`parent`) and the
+    JsrtDescription it shares with it.
+
     """
+    __slots__ = ("image", "image_path", "image_height", "image_width", "_image_type", "_description",
+                 "_x_coordinate", "_y_coordinate", "_position", "_transforms", "_pyramid", "parent")
+
+    _degree_of_subtlety = _description_property("degree_of_subtlety")
+    _nodule_size = _description_property("nodule_size")
+    _age = _description_property("age")
+    _sex = _description_property("sex")
+    _malignant_or_benign = _description_property("malignant_or_benign")
+    _diagnosis = _description_property("diagnosis")
+
     def __init__(self):
         self.image = None
         self.image_path = None
         self.image_height = None
         self.image_width = None
         self._image_type = None
-        self._malignant_or_benign = None
-        self._nodule_size = None
-        self._degree_of_subtlety = None
+        self._description = JsrtDescription(None, None, None, None, None, None)
         self._x_coordinate = -1
         self._y_coordinate = -1
-        self._diagnosis = None
-        self._age = None
-        self._sex = None
         self._position = None
+        # The image this one was made from by augmentation, None for images loaded from file.
+        self.parent = None
+        # Transforms applied to the image loaded from image_path, used as part of JsrtCache keys.
+        self._transforms = ()
+        # (image, {size: down sampled image}) of the image the levels were built from, see get_pyramid_level.
+        self._pyramid = (None, {})
+
+    def new_child(self):
+        """ This function gives a new JsrtImage object with the same image, coordinates and description as this one,
+        and this one as its parent. Augmentation functions transform the child in place. """
+        child = JsrtImage.__new__(JsrtImage)
+        for name in JsrtImage.__slots__:
+            setattr(child, name, getattr(self, name))
+        child.parent = self
+        return child
+
+    def __getstate__(self):
+        """ Pickles (and copies) the image without its parent and pyramid levels, which would otherwise pull in the
+        pixels of every image it was made from. The unpickled image has no parent. """
+        state = dict((name, getattr(self, name)) for name in JsrtImage.__slots__)
+        state["parent"] = None
+        state["_pyramid"] = (None, {})
+        return state
+
+    def __setstate__(self, state):
+        for name, value in state.items():
+            setattr(self, name, value)
 
     def load_image(self, image, height, width, x, y):
         self.image = image
@@ -40,11 +507,24 @@ class JsrtImage(object):
         self._y_coordinate = y
         return self
 
-    def load_from_file(self, path):
-        """ Image is of size 2048x2048 in gray scale stored in 16 bit unsigned int in big endian format. """
+    def load_from_file(self, path, lazy=False):
+        """ Image is of size 2048x2048 in gray scale stored in 16 bit unsigned int in big endian format. It is byte
+        swapped once, while loading, to a native uint16 array so that later numpy and scipy operations on it do not.
+
+        Args:
+            path  (str): Path to the .IMG file.
+            lazy (bool): Defaults to False. When True the image is backed by a read-only np.memmap instead of being
+                         read into memory, so pixel pages are only read from disk when they are actually accessed.
+                         The memory mapped image keeps the big endian byte order of the file.
+
+        """
         self.image_path = path
-        raw_image = np.fromfile(self.image_path, dtype=">i2").reshape((2048, 2048))
-        raw_image.shape = (2048, 2048)
+        with _stage("load") as stage:
+            if lazy is True:
+                raw_image = np.memmap(self.image_path, dtype=">u2", mode="r", shape=(2048, 2048))
+            else:
+                raw_image = np.fromfile(self.image_path, dtype=">u2").astype(np.uint16).reshape((2048, 2048))
+                stage.nbytes = raw_image.nbytes
         self.image = raw_image
         self.image_height = 2048
         self.image_width = 2048
@@ -84,6 +564,9 @@ class JsrtImage(object):
         self._image_type = value
 
     def display(self, opacity=0.1, nodule_marking=True):
+        import matplotlib.pyplot as plt
+        import matplotlib.cm as cm
+
         # Spectral yellow color at a range 0.5 is used.
         # https://matplotlib.org/mpl_examples/color/colormaps_reference_02.png
         if nodule_marking is True:
@@ -112,20 +595,16 @@ class JsrtImage(object):
         """
         if has_nodule is True:
             self._image_type = "has nodule"
-            self._degree_of_subtlety = data[1]
-            self._nodule_size = int(data[2])
-            self._age = int(data[3] if data[3] != "?" else 0)
-            self._sex = str(data[4])
+            self._description = JsrtDescription(degree_of_subtlety=data[1], nodule_size=int(data[2]),
+                                                age=int(data[3] if data[3] != "?" else 0), sex=str(data[4]),
+                                                malignant_or_benign=str(data[7]), diagnosis=str(data[9]))
             self._x_coordinate = int(data[5])
             self._y_coordinate = int(data[6])
-            self._malignant_or_benign = str(data[7])
             self._position = str(data[8])
-            self._diagnosis = str(data[9])
 
         elif has_nodule is False:
             self._image_type = "non-nodule"
-            self._age = data[1]
-            self._sex = data[2]
+            self._description = self._description._replace(age=data[1], sex=data[2])
             self._x_coordinate = -1
             self._y_coordinate = -1
         return self
@@ -158,70 +637,103 @@ class JsrtImage(object):
         similar to the flip.
 
         """
-        # np.fliplr - Flips array in the left/right direction.
-        self.image = np.fliplr(self.image)
+        with _stage("horizontal_reflection"):
+            # np.fliplr - Flips array in the left/right direction.
+            self.image = np.fliplr(self.image)
+            self._reflect_nodule()
+            self._transforms += (("reflect",),)
+        logger.debug("%s was horizontally reflected.", self.image_path)
+        return self
+
+    def _reflect_nodule(self):
+        """ Changes the nodule x coordinate and position (if present) for a horizontal flip of the image. """
         if self._image_type == "has nodule":
             # New position of the lung nodule, after reflection
-            self._x_coordinate = self.image_width - self._x_coordinate
-            if "left" in self._position:
-                self._position = self._position.replace("left", "right")
-            elif "l." in self._position:
-                self._position = self._position.replace("l.", "r.")
-            elif "right" in self._position:
-                self._position = self._position.replace("right", "left")
-            elif "r." in self._position:
-                self._position = self._position.replace("r.", "l.")
-        print str(self.image_path) + " was horizontally reflected."
-        return self
+            self._x_coordinate = self.image_width - 1 - self._x_coordinate
+            self._reflect_position()
+
+    def _reflect_position(self):
+        """ Changes the doctors diagnosis position from "left" to "right" or vice-versa. """
+        if "left" in self._position:
+            self._position = self._position.replace("left", "right")
+        elif "l." in self._position:
+            self._position = self._position.replace("l.", "r.")
+        elif "right" in self._position:
+            self._position = self._position.replace("right", "left")
+        elif "r." in self._position:
+            self._position = self._position.replace("r.", "l.")
 
-    def rotate(self, degrees):
-        """ This function does a counter clockwise rotation of image to the amount of degrees given. It uses
-        scipy.ndimage's rotate function to rotate the image. The function also adjusts the position of the x and
-        y coordinate of the nodule correctly.
+    @staticmethod
+    def get_rotation_matrix(shape, degrees):
+        """ This function gives the affine matrix and offset used to rotate an image of `shape` counter clockwise by
+        `degrees` about its center, in the form expected by scipy.ndimage.affine_transform.
 
-        HACK: get_rotate_mat function is actually the code from scipy.ndimage.rotate function to get the rotation matrix
-        that was used for image transformation. This helps to get the new coordinates of the lung nodule in the
-        rotated image.
+        HACK: This is actually the code from scipy.ndimage.rotate function to get the rotation matrix that is used for
+        image transformation. This helps to get the new coordinates of the lung nodule in the rotated image.
 
         https://github.com/scipy/scipy/blob/bcbb9381bc5cf7868b2f96c59302ef04faafa6d9/scipy/ndimage/interpolation.py#L658-784
 
+        Args:
+            shape   (tuple): (height, width) of the image.
+            degrees (float): rotation angle in degrees. If a negative value is given, then clockwise rotation occurs.
+
+        Returns:
+            offset, matrix (array, array): offset of shape (2,) and matrix of shape (2, 2).
+
+        """
+        angle = np.deg2rad(degrees)
+        m11 = math.cos(angle)
+        m12 = math.sin(angle)
+        m21 = -math.sin(angle)
+        m22 = math.cos(angle)
+        matrix = np.array([[m11, m12], [m21, m22]], dtype=np.float64)
+        iy = shape[0]
+        ix = shape[1]
+        oy = shape[0]
+        ox = shape[1]
+        offset = np.zeros((2,), dtype=np.float64)
+        offset[0] = float(oy) / 2.0 - 0.5
+        offset[1] = float(ox) / 2.0 - 0.5
+        offset = np.dot(matrix, offset)
+        tmp = np.zeros((2,), dtype=np.float64)
+        tmp[0] = float(iy) / 2.0 - 0.5
+        tmp[1] = float(ix) / 2.0 - 0.5
+        offset = tmp - offset
+        return offset, matrix
+
+    def rotate(self, degrees, order=3):
+        """ This function does a counter clockwise rotation of image to the amount of degrees given. It uses
+        scipy.ndimage's affine_transform function with the matrix of scipy.ndimage.rotate to rotate the image. The
+        function also adjusts the position of the x and y coordinate of the nodule correctly.
+
+        See Also: JsrtImage.get_rotation_matrix
+
         Args:
             degrees (int): rotation angle in degrees. If a negative value is given, then clockwise rotation occurs.
+            order   (int): Defaults to 3 (cubic spline). The order of the spline interpolation, 0 (nearest) and
+                           1 (bilinear) are much faster.
 
         Returns:
             None
             ( Existing image is rotated by degrees amount and new coordinates of lung nodule are added. )
 
         """
-        image_rotated = ndimage.rotate(self.image, degrees, mode="nearest", reshape=False)
-        self.image = image_rotated[:2048, :2048]
+        with _stage("rotate"):
+            off, mat = self.get_rotation_matrix(self.image.shape, degrees)
+            image_rotated = ndimage.affine_transform(self.image, mat, off, order=order, mode="nearest")
+            self._rotate_nodule(degrees)
+            self._transforms += (("rotate", degrees, order),)
+            self.image = image_rotated[:2048, :2048]
+        logger.debug("%s was rotated by %s degrees.", self.image_path, degrees)
+        return self
+
+    def _rotate_nodule(self, degrees):
+        """ Changes the nodule x and y coordinates (if present) for a rotation of the image by `degrees`. """
         if self._image_type == "has nodule":
-            def get_rotate_mat(shape, angle):
-                m11 = math.cos(angle)
-                m12 = math.sin(angle)
-                m21 = -math.sin(angle)
-                m22 = math.cos(angle)
-                matrix = np.array([[m11, m12], [m21, m22]], dtype=np.float64)
-                iy = shape[0]
-                ix = shape[1]
-                oy = shape[0]
-                ox = shape[1]
-                offset = np.zeros((2,), dtype=np.float64)
-                offset[0] = float(oy) / 2.0 - 0.5
-                offset[1] = float(ox) / 2.0 - 0.5
-                offset = np.dot(matrix, offset)
-                tmp = np.zeros((2,), dtype=np.float64)
-                tmp[0] = float(iy) / 2.0 - 0.5
-                tmp[1] = float(ix) / 2.0 - 0.5
-                offset = tmp - offset
-                return offset, matrix
-
-            off, mat = get_rotate_mat(self.image.shape, np.deg2rad(degrees))
+            off, mat = self.get_rotation_matrix(self.image.shape, degrees)
             a = np.dot(mat, [[self._x_coordinate], [self._y_coordinate]])
             self._x_coordinate = a[0][0] + off[0]
             self._y_coordinate = a[1][0] + off[1]
-        print str(self.image_path) + " was rotated by " + str(degrees) + "°."
-        return self
 
     def crop(self, size, x, y):
         """ This function obtains a cropped image of `size`. The image is cropped as a square with location x and y
@@ -262,47 +774,1043 @@ class JsrtImage(object):
         if y + half_size > 2048:
             bottom_offset = half_size + 2048 - y
 
-        crop = np.zeros((size, size), dtype=">i2")
-        width = right_offset - left_offset
-        height = bottom_offset - top_offset
+        with _stage("crop"):
+            crop = np.zeros((size, size), dtype=self.image.dtype.newbyteorder("="))
+            width = right_offset - left_offset
+            height = bottom_offset - top_offset
 
-        crop[top_offset: bottom_offset, left_offset: right_offset] = \
-            self.image[top_y: top_y + height, left_x: left_x + width]
+            crop[top_offset: bottom_offset, left_offset: right_offset] = \
+                self.image[top_y: top_y + height, left_x: left_x + width]
         return crop
 
-    def down_sample(self, ratio):
+    def crop_batch(self, size, x, y, out=None):
+        """ This function obtains many cropped images (glimpses) of `size` at once. It is the batch version of crop:
+        the crop of center x[i], y[i] is out[i], and the parts of a crop outside the image are filled with zeros. All
+        the crops are gathered with a single indexing operation.
+
+        See Also: JsrtImage.crop, JsrtImage.crop_windows, Jsrt.crop_images
+
+        Args:
+            size   (int): glimpse/cropped image size
+            x    (array): x coordinates of the crop locations' (center/middle) positions.
+            y    (array): y coordinates of the crop locations' (center/middle) positions.
+            out  (array): Defaults to None. A preallocated array of shape (len(x), size, size) to write the crops to.
+
+        Returns:
+            out (array): numpy array of (len(x), size, size)
+
+        """
+        x = np.asarray(x, dtype=np.intp).ravel()
+        y = np.asarray(y, dtype=np.intp).ravel()
+        if len(x) != len(y) or size < 0 or (x < 0).any() or (y < 0).any():
+            raise ValueError("Crop: Invalid x, y coordinates or size")
+        if out is None:
+            out = np.empty((len(x), size, size), dtype=self.image.dtype.newbyteorder("="))
+        with _stage("crop_batch"):
+            height, width = self.image.shape
+            offsets = np.arange(size) - size // 2
+            rows = y[:, np.newaxis] + offsets
+            columns = x[:, np.newaxis] + offsets
+            out[...] = self.image[np.clip(rows, 0, height - 1)[:, :, np.newaxis],
+                                  np.clip(columns, 0, width - 1)[:, np.newaxis, :]]
+            inside = ((rows >= 0) & (rows < height))[:, :, np.newaxis] & \
+                     ((columns >= 0) & (columns < width))[:, np.newaxis, :]
+            out[~inside] = 0
+        return out
+
+    def crop_windows(self, size):
+        """ This function gives a read-only view of all the crops of `size` that are fully inside the image, without
+        copying anything. The crop of center x, y (same as crop(size, x, y)) is
+        crop_windows(size)[y - size // 2, x - size // 2], which is itself a view into the image.
+
+        Args:
+            size (int): glimpse/cropped image size
+
+        Returns:
+            windows (array): numpy array view of (height - size + 1, width - size + 1, size, size)
+
+        """
+        height, width = self.image.shape
+        if size < 0 or size > min(height, width):
+            raise ValueError("Crop: Invalid size")
+        return np.lib.stride_tricks.as_strided(self.image, shape=(height - size + 1, width - size + 1, size, size),
+                                               strides=self.image.strides * 2, writeable=False)
+
+    def down_sample(self, ratio, method="nearest"):
         """ This function down samples the image by `ratio` factor. Image is re-sampled by a factor of
-        `ratio` with nearest interpolation.
+        `ratio` with nearest interpolation, or by averaging the pixels of the image covered by each new pixel.
 
         Args:
             ratio (float): ratio to which image is to be reduced.
+            method  (str): Defaults to "nearest". With "area" each new pixel is the average of the area of the image it
+                           covers (for example ratio 1 / 25.6 gives a 80x80 image, each pixel averaging a 25.6x25.6
+                           area of the 2048x2048 image).
 
         Returns:
             new_image (array): image
         """
-        # order 0 nearest interpolation
-        # order 1 bilinear interpolation
-        new_image = ndimage.zoom(self.image, ratio, order=0)
+        with _stage("down_sample"):
+            if method == "area":
+                shape = tuple(int(round(side * ratio)) for side in self.image.shape)
+                return _area_average(self.image, shape)
+            # order 0 nearest interpolation
+            # order 1 bilinear interpolation
+            new_image = ndimage.zoom(self.image, ratio, order=0)
+        return new_image
+
+    def get_pyramid_level(self, size, cache=None):
+        """ This function gives the image down sampled to (size, size) by area averaging. Levels are kept in memory
+        once built, so repeated requests for a size are lookups. Every level is averaged from the image itself (not
+        from a rounded larger level), so it is the same as _area_average(image, (size, size)) whatever was built
+        before.
+
+        See Also: JsrtImage.build_pyramid
+
+        Args:
+            size          (int): Side of the down sampled image.
+            cache   (JsrtCache): Defaults to None. When given, levels are also read from or stored in the cache on disk.
+
+        Returns:
+            level (array): numpy array of (size, size)
+
+        """
+        if self._pyramid[0] is not self.image:
+            self._pyramid = (self.image, {})
+        levels = self._pyramid[1]
+        if size not in levels:
+            transforms = self._transforms + (("area", size),)
+            cached_image = None if cache is None else cache.get(self, transforms)
+            if cached_image is not None:
+                levels[size] = cached_image.image
+            else:
+                levels[size] = _area_average(self.image, (size, size))
+                if cache is not None:
+                    level_image = self.new_child()
+                    level_image.image = levels[size]
+                    level_image._transforms = transforms
+                    cache.put(level_image)
+        return levels[size]
+
+    def build_pyramid(self, sizes=(1024, 512, 256, 299), cache=None):
+        """ This function builds the area averaged down sampled images of all `sizes`.
+        See Also: JsrtImage.get_pyramid_level """
+        for size in sorted(sizes, reverse=True):
+            self.get_pyramid_level(size, cache)
+        return self
+
+
+class JsrtTransform(object):
+    """ JsrtTransform composes horizontal reflection, rotation, crop and down sampling into a single affine matrix, so
+    that a JsrtImage is resampled only once, directly from the source image into the (small) output image. The nodule
+    x and y coordinates are carried through the same matrix.
+
+    The steps are applied in the order they are added and each step works on the output of the previous one, same as
+    calling the JsrtImage methods one after another: the pixels of a crop outside the image are 0 as with
+    JsrtImage.crop, and the result only differs by the interpolation, which is done once instead of at every step.
+
+    Examples:
+        transform = JsrtTransform().horizontal_reflection().rotate(2).crop(1200, 1024, 1024).down_sample(299 / 1200.)
+        new_image = transform.apply(nodule_images[0])  # new_image.image is a 299x299 array
+
+    """
+    def __init__(self, shape=(2048, 2048)):
+        self.source_shape = tuple(shape)
+        self.shape = tuple(shape)
+        self.reflected = False
+        # Maps homogeneous source coordinates [x, y, 1] to output coordinates.
+        self.matrix = np.eye(3, dtype=np.float64)
+        # (matrix, shape) of the image each crop was taken from, its pixels outside that image are 0.
+        self.crop_frames = []
+
+    def _add(self, matrix, shape):
+        self.matrix = np.dot(matrix, self.matrix)
+        self.shape = shape
+        return self
+
+    def horizontal_reflection(self):
+        """ Adds a horizontal flip. See Also: JsrtImage.horizontal_reflection """
+        self.reflected = not self.reflected
+        matrix = np.array([[-1, 0, self.shape[1] - 1], [0, 1, 0], [0, 0, 1]], dtype=np.float64)
+        return self._add(matrix, self.shape)
+
+    def rotate(self, degrees):
+        """ Adds a counter clockwise rotation by `degrees` about the image center. See Also: JsrtImage.rotate """
+        offset, rotation = JsrtImage.get_rotation_matrix(self.shape, degrees)
+        matrix = np.eye(3, dtype=np.float64)
+        matrix[:2, :2] = rotation
+        matrix[:2, 2] = offset
+        return self._add(matrix, self.shape)
+
+    def crop(self, size, x, y):
+        """ Adds a square crop of `size` centered at x and y. See Also: JsrtImage.crop """
+        if x < 0 or y < 0 or size < 0:
+            raise ValueError("Crop: Invalid x, y coordinates or size")
+        half_size = size // 2
+        self.crop_frames.append((self.matrix, self.shape))
+        matrix = np.array([[1, 0, half_size - x], [0, 1, half_size - y], [0, 0, 1]], dtype=np.float64)
+        return self._add(matrix, (size, size))
+
+    def down_sample(self, ratio):
+        """ Adds a down sampling by `ratio` factor. See Also: JsrtImage.down_sample """
+        shape = tuple(int(round(side * ratio)) for side in self.shape)
+        # Same grid as scipy.ndimage.zoom, the corner pixels of input and output are aligned.
+        scale = [float(new_side - 1) / (side - 1) if side > 1 else 1.0 for side, new_side in zip(self.shape, shape)]
+        matrix = np.diag([scale[1], scale[0], 1.0])
+        return self._add(matrix, shape)
+
+    def apply(self, jsrt_image, order=1, mode="nearest", cache=None):
+        """ This function resamples the image of jsrt_image through the composed transform in one step.
+
+        Args:
+            jsrt_image (JsrtImage): The source image. Its image must be of shape `source_shape`.
+            order            (int): Defaults to 1 (bilinear). The order of the spline interpolation.
+            mode             (str): Defaults to "nearest". How points outside the source image are filled, see
+                                    scipy.ndimage.affine_transform. Same as JsrtImage.crop, the pixels of a crop that
+                                    are outside the image it is taken from are 0 whatever the mode.
+            cache      (JsrtCache): Defaults to None. When given, the result is read from or stored in the cache.
+
+        Returns:
+            new_image (JsrtImage): A new JsrtImage object holding the transformed image and nodule coordinates.
+
+        """
+        crop_frames = tuple((tuple(matrix.ravel()), shape) for matrix, shape in self.crop_frames)
+        transform = ("transform", tuple(self.matrix.ravel()), self.shape, order, mode, crop_frames)
+        if cache is not None:
+            new_image = cache.get(jsrt_image, jsrt_image._transforms + (transform,))
+            if new_image is not None:
+                return new_image
+
+        if jsrt_image.image.shape != self.source_shape:
+            raise ValueError("Transform: image shape " + str(jsrt_image.image.shape) + " does not match " +
+                             str(self.source_shape))
+        with _stage("transform"):
+            # scipy.ndimage works in (row, column) = (y, x) order and maps output coordinates to input coordinates.
+            swap = np.array([[0, 1, 0], [1, 0, 0], [0, 0, 1]], dtype=np.float64)
+            inverse = np.dot(swap, np.dot(np.linalg.inv(self.matrix), swap))
+            image = ndimage.affine_transform(jsrt_image.image, inverse[:2, :2], inverse[:2, 2],
+                                             output_shape=self.shape, order=order, mode=mode)
+            if self.crop_frames:
+                rows, columns = np.mgrid[:self.shape[0], :self.shape[1]]
+                points = np.array([columns.ravel(), rows.ravel(), np.ones(rows.size)], dtype=np.float64)
+                source_points = np.dot(np.linalg.inv(self.matrix), points)
+                outside = np.zeros(rows.size, dtype=bool)
+                for matrix, (height, width) in self.crop_frames:
+                    x, y, _ = np.dot(matrix, source_points)
+                    outside |= (x < -0.5) | (x > width - 0.5) | (y < -0.5) | (y > height - 0.5)
+                image[outside.reshape(self.shape)] = 0
+
+        new_image = jsrt_image.new_child()
+        x, y = jsrt_image.x, jsrt_image.y
+        if jsrt_image.image_type == "has nodule":
+            x, y, _ = np.dot(self.matrix, [x, y, 1])
+            if self.reflected is True:
+                new_image._reflect_position()
+        new_image._transforms = jsrt_image._transforms + (transform,)
+        new_image.load_image(image, self.shape[0], self.shape[1], x, y)
+        if cache is not None:
+            cache.put(new_image)
+        return new_image
+
+
+class JsrtCache(object):
+    """ JsrtCache is a persistent on-disk cache of augmented JsrtImage objects. An entry is keyed by the source image
+    file (path, modification time and size) and the transforms applied to it (reflection, rotation angle and
+    interpolation order, JsrtTransform matrix), and it stores the resulting image with the nodule x, y coordinates and
+    position. When the entries grow past `max_bytes`, the least recently used ones are removed.
+
+    Examples:
+        cache = JsrtCache("./augment_cache/", max_bytes=20 * 2 ** 30)
+        jsrtdata.augment_images(rotate_angles=[1, 2], cache=cache)
+        print cache.hits, cache.misses
+
+    """
+    def __init__(self, directory, max_bytes=8 * 2 ** 30):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        if not exists(directory):
+            makedirs(directory)
+        # key -> size in bytes, least recently used first.
+        entries = [(stat(join(directory, name)).st_mtime, name[:-len(".npz")], getsize(join(directory, name)))
+                   for name in listdir(directory) if name.endswith(".npz")]
+        self._entries = OrderedDict((key, size) for _, key, size in sorted(entries))
+        self.size = sum(self._entries.values())
+        self._evict()
+
+    @staticmethod
+    def key(image_path, transforms):
+        """ Gives the cache key of the image loaded from image_path after `transforms`, or None when the image was not
+        loaded from a file. """
+        if image_path is None or not exists(image_path):
+            return None
+        source = stat(image_path)
+        description = repr((abspath(image_path), source.st_mtime, source.st_size, transforms))
+        return hashlib.sha1(description).hexdigest()
+
+    def _filename(self, key):
+        return join(self.directory, key + ".npz")
+
+    def get(self, jsrt_image, transforms):
+        """ This function looks up the image obtained by applying `transforms` to the image loaded from the file of
+        jsrt_image.
+
+        Args:
+            jsrt_image (JsrtImage): The image the transforms are applied to.
+            transforms     (tuple): All the transforms applied to the source file, see JsrtImage._transforms.
+
+        Returns:
+            new_image (JsrtImage): A new JsrtImage object with the cached image, or None when it is not in the cache.
+            An entry whose file was removed (for example evicted by another run sharing the directory) or cannot be
+            read is a miss, and it is dropped.
+
+        """
+        key = self.key(jsrt_image.image_path, transforms)
+        if key is None or key not in self._entries:
+            self.misses += 1
+            return None
+        try:
+            with np.load(self._filename(key)) as entry:
+                new_image = jsrt_image.new_child()
+                new_image.image = entry["image"]
+                new_image.image_height, new_image.image_width = new_image.image.shape
+                if new_image.image_type == "has nodule":
+                    new_image._x_coordinate = entry["x"].item()
+                    new_image._y_coordinate = entry["y"].item()
+                    new_image._position = str(entry["position"])
+            utime(self._filename(key), None)
+        except (IOError, OSError, ValueError, KeyError, BadZipfile):
+            logger.warning("Cache entry %s cannot be read, it is dropped.", key)
+            self.size -= self._entries.pop(key)
+            if exists(self._filename(key)):
+                remove(self._filename(key))
+            self.misses += 1
+            return None
+        new_image._transforms = transforms
+        self._entries[key] = self._entries.pop(key)
+        self.hits += 1
         return new_image
 
+    def put(self, jsrt_image):
+        """ This function stores jsrt_image in the cache, keyed by its file and its transforms, and removes the least
+        recently used entries if the cache is over max_bytes. """
+        key = self.key(jsrt_image.image_path, jsrt_image._transforms)
+        if key is None:
+            return
+        handle, temporary_filename = mkstemp(suffix=".tmp", dir=self.directory)
+        close(handle)
+        with open(temporary_filename, "wb") as entry:
+            np.savez(entry, image=jsrt_image.image, x=jsrt_image.x, y=jsrt_image.y,
+                     position=str(jsrt_image._position))
+        rename(temporary_filename, self._filename(key))
+        self.size += getsize(self._filename(key)) - self._entries.pop(key, 0)
+        self._entries[key] = getsize(self._filename(key))
+        self._evict()
+
+    def _evict(self):
+        """ Removes the least recently used entries until the cache is within max_bytes. The latest entry is kept. """
+        while self.size > self.max_bytes and len(self._entries) > 1:
+            old_key, old_size = self._entries.popitem(last=False)
+            if exists(self._filename(old_key)):
+                remove(self._filename(old_key))
+            self.size -= old_size
+
+
+class JsrtSpill(object):
+    """ JsrtSpill keeps the pixels of new images within a memory budget. Images are admitted as they are made: while
+    the resident pixel data (images held in memory, not memory mapped) is within `memory_budget` bytes they stay in
+    memory, and after that they are appended to stack files on disk and replaced by read-only np.memmap views of them.
+    The images stay ordinary JsrtImage objects in ordinary lists, only their pixels are paged in from disk when used.
+    Each stack file is memory mapped once and its images are views of that map, so the open files grow with the number
+    of stack files rather than of images.
+
+    See Also: Jsrt (its memory_budget argument)
+
+    Args:
+        memory_budget (int): Bytes of resident pixel data allowed before new images are spilled to disk.
+        directory     (str): Defaults to None (the system temporary directory). Where the stack files are written.
+        stack_size    (int): Defaults to 64. Number of images in a stack file (of the size of the first image written
+                             to it, the file is started sparse).
+
+    """
+    def __init__(self, memory_budget, directory=None, stack_size=64):
+        self.memory_budget = memory_budget
+        self.stack_size = stack_size
+        self.resident_bytes = 0
+        self.spilled = 0
+        self.directory = mkdtemp(prefix="jsrt_spill_", dir=directory)
+        self._stack = None
+        self._stack_map = None
+
+    def __del__(self):
+        self.close()
+
+    def close(self):
+        """ Removes the stack files. The images already spilled stay readable, as their files are kept open by
+        their memory maps. """
+        if self._stack is not None:
+            self._stack.close()
+            self._stack = None
+            self._stack_map = None
+        if self.directory is not None and exists(self.directory):
+            shutil.rmtree(self.directory, ignore_errors=True)
+
+    @staticmethod
+    def _resident(jsrt_image):
+        """ Gives the bytes of memory held by the pixels of jsrt_image alone: 0 when they are memory mapped or a view
+        of the pixels of its parent. """
+        base = jsrt_image.image
+        while isinstance(base, np.ndarray) and base.base is not None:
+            base = base.base
+        if isinstance(base, mmap.mmap):
+            return 0
+        if jsrt_image.parent is not None and np.may_share_memory(jsrt_image.image, jsrt_image.parent.image):
+            return 0
+        return jsrt_image.image.nbytes
+
+    def add(self, jsrt_images):
+        """ Counts the pixels of jsrt_images (such as the loaded images) as resident without spilling them. """
+        for jsrt_image in jsrt_images:
+            self.resident_bytes += self._resident(jsrt_image)
+
+    def admit(self, jsrt_image):
+        """ This function keeps the pixels of a new image in memory while within the budget, and otherwise moves them
+        to a stack file on disk.
+
+        Args:
+            jsrt_image (JsrtImage): A new image.
+
+        Returns:
+            jsrt_image (JsrtImage): The same image, its image now possibly a read-only np.memmap.
+
+        """
+        nbytes = self._resident(jsrt_image)
+        if nbytes == 0:
+            return jsrt_image
+        if self.resident_bytes + nbytes <= self.memory_budget:
+            self.resident_bytes += nbytes
+            return jsrt_image
+        raster = np.ascontiguousarray(jsrt_image.image)
+        if self._stack is None or self._stack.tell() + raster.nbytes > len(self._stack_map):
+            if self._stack is not None:
+                self._stack.close()
+            handle, filename = mkstemp(suffix=".stack", dir=self.directory)
+            close(handle)
+            self._stack = open(filename, "wb")
+            self._stack.truncate(self.stack_size * max(raster.nbytes, 1))
+            self._stack_map = np.memmap(filename, dtype=np.uint8, mode="r")
+        with _stage("spill_write", raster.nbytes):
+            offset = self._stack.tell()
+            self._stack.write(raster.tostring())
+            self._stack.flush()
+        jsrt_image.image = self._stack_map[offset:offset + raster.nbytes].view(raster.dtype).reshape(raster.shape)
+        self.spilled += 1
+        return jsrt_image
+
+
+class JsrtDataset(object):
+    """ JsrtDataset is a native binary container of JsrtImage objects that is read through np.memmap. The file is a
+    4096 byte header, followed by all the images as one contiguous (count, height, width) pixel block and a fixed width
+    metadata table holding the fields of JsrtImage.get_all_details. Opening a dataset does not read any pixels and
+    dataset[index] gives a JsrtImage whose image is a view into the file.
+
+    Datasets saved with packed=True store the pixels 12 bits each (see pack_12bit), which is 25% smaller, and
+    dataset[index] unpacks the image into a native uint16 array instead of giving a view.
+
+    Examples:
+        JsrtDataset.save(jsrtdata.get_images(num_of_images=50), "train_images.jsrt")
+        dataset = JsrtDataset("train_images.jsrt")
+        print len(dataset), dataset[10].image.shape
+
+    """
+    MAGIC = "JSRTDSET"
+    HEADER_SIZE = 4096
+    # Header dtype of datasets saved with packed=True.
+    PACKED_12BIT = "p12"
+    HEADER_DTYPE = np.dtype([("magic", "S8"), ("count", "<u8"), ("height", "<u8"), ("width", "<u8"),
+                             ("dtype", "S8"), ("table_offset", "<u8")])
+    METADATA_DTYPE = np.dtype([("image_path", "S256"), ("image_type", "S16"), ("subtlety", "S8"),
+                               ("nodule_size", "<i4"), ("age", "S8"), ("sex", "S8"), ("x", "<f8"), ("y", "<f8"),
+                               ("malignant_or_benign", "S16"), ("position", "S64"), ("diagnosis", "S64")])
+
+    def __init__(self, filename):
+        self.filename = filename
+        header = np.fromfile(filename, dtype=self.HEADER_DTYPE, count=1)
+        if len(header) != 1 or header["magic"][0] != self.MAGIC:
+            raise ValueError(str(filename) + " is not a JsrtDataset file")
+        header = header[0]
+        self._count = int(header["count"])
+        self.image_height = int(header["height"])
+        self.image_width = int(header["width"])
+        self.packed = header["dtype"] == self.PACKED_12BIT
+        if self.packed:
+            shape = (self._count, (self.image_height * self.image_width + 1) // 2 * 3)
+            dtype = np.uint8
+        else:
+            shape = (self._count, self.image_height, self.image_width)
+            dtype = header["dtype"]
+        self.images = np.memmap(filename, dtype=dtype, mode="r", offset=self.HEADER_SIZE,
+                                shape=shape) if self._count else None
+        self.table = np.memmap(filename, dtype=self.METADATA_DTYPE, mode="r", offset=int(header["table_offset"]),
+                               shape=(self._count,)) if self._count else None
+
+    def __len__(self):
+        return self._count
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self[i] for i in range(*index.indices(self._count))]
+        if index < 0:
+            index += self._count
+        if index < 0 or index >= self._count:
+            raise IndexError("JsrtDataset index out of range")
+        row = self.table[index]
+        image = self.images[index]
+        if self.packed:
+            image = unpack_12bit(image, (self.image_height, self.image_width))
+        img = JsrtImage()
+        img.load_image(image, self.image_height, self.image_width, float(row["x"]), float(row["y"]))
+        img.image_path = row["image_path"] or None
+        img.image_type = row["image_type"]
+        img._degree_of_subtlety = row["subtlety"] or None
+        img._nodule_size = int(row["nodule_size"]) if row["nodule_size"] >= 0 else None
+        img._age = (int(row["age"]) if img.image_type == "has nodule" else row["age"]) if row["age"] else None
+        img._sex = row["sex"] or None
+        img._malignant_or_benign = row["malignant_or_benign"] or None
+        img._position = row["position"] or None
+        img._diagnosis = row["diagnosis"] or None
+        return img
+
+    def __iter__(self):
+        for index in range(self._count):
+            yield self[index]
+
+    @staticmethod
+    def save(dataset, filename, packed=False):
+        """ This function writes the JsrtImage objects of dataset into a JsrtDataset file. All the images must be of
+        the same shape, they are stored with the dtype of the first image.
+
+        Args:
+            dataset (list): A list (or any iterable, such as Jsrt.iter_augmented) of JsrtImage objects.
+            filename (str): name of the file.
+            packed  (bool): Defaults to False. When True the pixels are stored 12 bits each, clipped to 0 to 4095.
+                            See Also: pack_12bit
+
+        """
+        if dataset is None:
+            raise ValueError('None obtained as dataset value')
+
+        def _text(value):
+            return "" if value is None else str(value)
+
+        header = np.zeros(1, dtype=JsrtDataset.HEADER_DTYPE)
+        header["magic"] = JsrtDataset.MAGIC
+        rows = []
+        with open(filename, "wb") as dataset_file:
+            dataset_file.write(header.tostring().ljust(JsrtDataset.HEADER_SIZE, "\0"))
+            for jsrtimage in dataset:
+                if not rows:
+                    header["height"], header["width"] = jsrtimage.image.shape
+                    header["dtype"] = JsrtDataset.PACKED_12BIT if packed is True else \
+                        jsrtimage.image.dtype.newbyteorder("=").str
+                elif jsrtimage.image.shape != (header["height"][0], header["width"][0]):
+                    raise ValueError("JsrtDataset: all images must be of the same shape")
+                with _stage("native_write") as stage:
+                    if packed is True:
+                        raster = pack_12bit(jsrtimage.image, clip=True).tostring()
+                    else:
+                        raster = np.asarray(jsrtimage.image, dtype=header["dtype"][0]).tostring()
+                    dataset_file.write(raster)
+                    stage.nbytes = len(raster)
+                rows.append((_text(jsrtimage.image_path), _text(jsrtimage._image_type),
+                             _text(jsrtimage._degree_of_subtlety),
+                             -1 if jsrtimage._nodule_size is None else jsrtimage._nodule_size,
+                             _text(jsrtimage._age), _text(jsrtimage._sex),
+                             jsrtimage.x, jsrtimage.y, _text(jsrtimage._malignant_or_benign),
+                             _text(jsrtimage._position), _text(jsrtimage._diagnosis)))
+            header["count"] = len(rows)
+            header["table_offset"] = dataset_file.tell()
+            np.array(rows, dtype=JsrtDataset.METADATA_DTYPE).tofile(dataset_file)
+            dataset_file.seek(0)
+            dataset_file.write(header.tostring())
+
+
+class JsrtRecordFile(object):
+    """ JsrtRecordFile reads the JsrtImage objects of tfrecords files written by Jsrt.save_images lazily. Records are
+    parsed by a background thread that keeps `prefetch` images ready, so only a few images are in memory at a time.
+
+    For uncompressed files an index of record offsets is built once and saved next to each file (as
+    <filename>.index.npy), which gives len() and O(1) random access to any record, so random order and subset reads do
+    not scan the whole file. Record checksums are not verified on these reads.
+
+    Examples:
+        records = JsrtRecordFile(["train.tfrecords-00000-of-00002", "train.tfrecords-00001-of-00002"])
+        print len(records), records[10].x
+        for image in records.iter_images(np.random.permutation(len(records))):
+            ...
+
+    """
+    def __init__(self, filenames, compression=None, prefetch=8):
+        self.filenames = [filenames] if isinstance(filenames, basestring) else list(filenames)
+        self.compression = compression
+        self.prefetch = prefetch
+        self._file_ids = None
+        self._offsets = None
+        self._lengths = None
+        if compression is None:
+            indexes = [self.load_index(filename) for filename in self.filenames]
+            self._file_ids = np.concatenate([np.full(len(index), file_id, dtype=np.int64)
+                                             for file_id, index in enumerate(indexes)] + [np.zeros(0, np.int64)])
+            self._offsets = np.concatenate([index[:, 0] for index in indexes] + [np.zeros(0, np.int64)])
+            self._lengths = np.concatenate([index[:, 1] for index in indexes] + [np.zeros(0, np.int64)])
+
+    @staticmethod
+    def load_index(filename):
+        """ This function gives the (offset, length) of the data of every record in an uncompressed tfrecords file.
+        The index is read from <filename>.index.npy, and it is built and saved there when missing or older than the
+        file.
+
+        Args:
+            filename (str): Path to the tfrecords file.
+
+        Returns:
+            index (array): An int64 array of shape (number of records, 2).
+
+        """
+        index_filename = filename + ".index.npy"
+        if exists(index_filename) and stat(index_filename).st_mtime >= stat(filename).st_mtime:
+            return np.load(index_filename)
+        index = []
+        with open(filename, "rb") as record_file:
+            while True:
+                # A record is: uint64 length, uint32 crc of length, data, uint32 crc of data.
+                header = record_file.read(12)
+                if len(header) < 12:
+                    break
+                length = struct.unpack("<Q", header[:8])[0]
+                index.append((record_file.tell(), length))
+                record_file.seek(length + 4, 1)
+        index = np.array(index, dtype=np.int64).reshape((-1, 2))
+        try:
+            np.save(index_filename, index)
+        except IOError:
+            pass
+        return index
+
+    def _check_index(self):
+        if self._offsets is None:
+            raise TypeError("Random access needs an index, which is not available for compressed tfrecords files")
+
+    def __len__(self):
+        self._check_index()
+        return len(self._offsets)
+
+    def _read_records(self, indices):
+        """ Reads the serialized records at indices, keeping the files open between reads. """
+        record_files = {}
+        try:
+            for index in indices:
+                file_id = self._file_ids[index]
+                if file_id not in record_files:
+                    record_files[file_id] = open(self.filenames[file_id], "rb")
+                record_files[file_id].seek(self._offsets[index])
+                yield record_files[file_id].read(self._lengths[index])
+        finally:
+            for record_file in record_files.values():
+                record_file.close()
+
+    def __getitem__(self, index):
+        self._check_index()
+        if index < 0:
+            index += len(self)
+        if index < 0 or index >= len(self):
+            raise IndexError("JsrtRecordFile index out of range")
+        return Jsrt._from_example(next(self._read_records([index])))
+
+    def iter_images(self, indices=None):
+        """ This function yields the JsrtImage objects of the files, in file order or in the order given by indices.
+
+        Args:
+            indices (list): Defaults to None. Record indices to read, in any order. Needs the index, so it is not
+                            available for compressed files.
+
+        Yields:
+            JsrtImage objects.
+
+        """
+        if indices is None:
+            import tensorflow as tf
+
+            options = Jsrt._compression_options(self.compression)
+            records = (string_record for filename in self.filenames
+                       for string_record in tf.python_io.tf_record_iterator(path=filename, options=options))
+        else:
+            self._check_index()
+            records = self._read_records([int(index) for index in indices])
+        return _prefetch((Jsrt._from_example(string_record) for string_record in records), self.prefetch)
+
+    def __iter__(self):
+        return self.iter_images()
+
+
+class JsrtSampler(object):
+    """ JsrtSampler gives random mini-batches of the images loaded in a Jsrt object as fixed-shape numpy arrays. The
+    batches are made by a background thread that keeps `prefetch` batches ready, so the training loop does not wait for
+    disk reads or transforms. The same seed gives the same batches.
+
+    Each batch is a tuple (images, labels, coordinates) of arrays of shapes (batch_size, height, width),
+    (batch_size,) with 1 for has-nodule and 0 for non-nodule images, and (batch_size, 2) with the nodule x and y.
+
+    Examples:
+        jsrtdata = Jsrt().load_images("./All247images/", lazy=True)
+        sampler = JsrtSampler(jsrtdata, batch_size=16, balanced=True, size=299, augment=True, seed=0)
+        for images, labels, coordinates in sampler:
+            ...
+
+    """
+    def __init__(self, jsrt, batch_size=32, balanced=False, size=None, augment=False, rotate_angles=(-2, -1, 0, 1, 2),
+                 order=1, seed=None, num_batches=None, prefetch=4):
+        """
+        Args:
+            jsrt           (Jsrt): A Jsrt object with loaded images.
+            batch_size      (int): Defaults to 32. Number of images in a batch.
+            balanced       (bool): Defaults to False. When True each image is a has-nodule or a non-nodule image with
+                                   equal chance, otherwise images are drawn uniformly from all the images.
+            size            (int): Defaults to None. When given, images are down sampled to (size, size).
+            augment        (bool): Defaults to False. When True each image is horizontally reflected with a 50% chance
+                                   and rotated by an angle drawn from rotate_angles.
+            rotate_angles  (list): Defaults to (-2, -1, 0, 1, 2). Angles (in degrees) used by augment.
+            order           (int): Defaults to 1. The order of the spline interpolation of the transforms.
+            seed            (int): Defaults to None. Seed of the random number generator.
+            num_batches     (int): Defaults to None. Number of batches given by an iteration, None for no end.
+            prefetch        (int): Defaults to 4. Number of batches made in advance.
+
+        """
+        self.image_lists = [jsrt._non_nodule_image_list or [], jsrt._has_nodule_image_list or []]
+        if not self.image_lists[0] and not self.image_lists[1]:
+            raise ValueError("JsrtSampler: no images loaded")
+        self.batch_size = batch_size
+        self.balanced = balanced
+        self.size = size
+        self.augment = augment
+        self.rotate_angles = list(rotate_angles)
+        self.order = order
+        self.seed = seed
+        self.num_batches = num_batches
+        self.prefetch = prefetch
+        first_image = (self.image_lists[0] or self.image_lists[1])[0].image
+        self.source_shape = first_image.shape
+        self.shape = (size, size) if size is not None else first_image.shape
+        self.dtype = first_image.dtype.newbyteorder("=")
+
+    def _sample(self, rng):
+        """ Draws an image and applies the random transforms to it. """
+        if self.balanced is True:
+            image_list = self.image_lists[rng.randint(2)] or self.image_lists[0] or self.image_lists[1]
+            image = image_list[rng.randint(len(image_list))]
+        else:
+            index = rng.randint(len(self.image_lists[0]) + len(self.image_lists[1]))
+            image = self.image_lists[0][index] if index < len(self.image_lists[0]) else \
+                self.image_lists[1][index - len(self.image_lists[0])]
+        if self.augment is False and self.size is None:
+            return image
+        transform = JsrtTransform(image.image.shape)
+        if self.augment is True:
+            if rng.rand() < 0.5:
+                transform.horizontal_reflection()
+            angle = self.rotate_angles[rng.randint(len(self.rotate_angles))]
+            if angle != 0:
+                transform.rotate(angle)
+        if self.size is not None:
+            transform.down_sample(float(self.size) / max(image.image.shape))
+        return transform.apply(image, order=self.order)
+
+    def _batches(self):
+        rng = np.random.RandomState(self.seed)
+        count = 0
+        while self.num_batches is None or count < self.num_batches:
+            images = np.empty((self.batch_size,) + self.shape, dtype=self.dtype)
+            labels = np.empty((self.batch_size,), dtype=np.int64)
+            coordinates = np.empty((self.batch_size, 2), dtype=np.float64)
+            for index in range(self.batch_size):
+                sample = self._sample(rng)
+                if sample.image.shape != self.shape:
+                    raise ValueError("JsrtSampler: all images must be of the same shape")
+                images[index] = sample.image
+                labels[index] = sample.image_type == "has nodule"
+                coordinates[index] = sample.x, sample.y
+            yield images, labels, coordinates
+            count += 1
+
+    def __iter__(self):
+        return _prefetch(self._batches(), self.prefetch)
+
+
+class JsrtSplit(object):
+    """ JsrtSplit is a read-only view of some of the images of a list: it holds the list and the indices of its images
+    in it, so making a split copies no images. It can be used like a list of JsrtImage objects, for example with
+    Jsrt.save_images, which then streams the images from it.
+
+    See Also: Jsrt.split
+
+    Args:
+        images  (list): The list of JsrtImage objects shared by the splits.
+        indices (list): Indices of the images of the split in `images`.
+
+    """
+    def __init__(self, images, indices):
+        self.images = images
+        self.indices = np.asarray(indices, dtype=np.intp)
+
+    def __len__(self):
+        return len(self.indices)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self.images[i] for i in self.indices[index]]
+        return self.images[self.indices[index]]
+
+    def __iter__(self):
+        for index in self.indices:
+            yield self.images[index]
+
+
+class JsrtPipeline(object):
+    """ JsrtPipeline runs the stages of a job (such as reading, transforming and writing images) at the same time,
+    each stage in its own threads, joined by bounded queues. While image k is transformed, image k + 1 is read and the
+    result of image k - 1 is written, so the job goes about as fast as its slowest stage instead of the sum of all of
+    them. numpy, scipy.ndimage and file I/O release the GIL for most of their work, so threads overlap well.
+
+    Args:
+        stages     (list): (name, function, workers) tuples. Every item goes through function(item) of each stage in
+                           turn, done by `workers` threads of that stage.
+        queue_size  (int): Defaults to 2. Number of items waiting between two stages. At most
+                           queue_size * (len(stages) + 1) + all the workers items are in the pipeline at a time.
+
+    Examples:
+        pipeline = JsrtPipeline([("read", lambda filename: JsrtImage().load_from_file(filename), 2),
+                                 ("transform", lambda image: image.new_child().rotate(2, order=1), 2)])
+        # The writing is the last stage, save_images writes while the next images are read and rotated.
+        Jsrt.save_images(pipeline.run(filenames), "rotated.tfrecords", shards=2, workers=2)
+
+    """
+    def __init__(self, stages, queue_size=2):
+        self.stages = [(name, function, max(1, workers)) for name, function, workers in stages]
+        self.queue_size = max(1, queue_size)
+
+    def run(self, items):
+        """ This function sends items through the stages.
+
+        Args:
+            items (iterable): The items given to the first stage, read by a background thread.
+
+        Yields:
+            The results of the last stage, in the order of items. An error raised by a stage is raised again here.
+
+        """
+        stop = Event()
+        done = object()
+        errors = []
+        lock = threading.Lock()
+        queues = [Queue(maxsize=self.queue_size) for _ in range(len(self.stages) + 1)]
+        finished = [0] * len(self.stages)
+        workers = [stage[2] for stage in self.stages] + [1]
+        # One token per item in the pipeline, given back when the item is yielded. It bounds the items waiting to be
+        # put back in order when a slow item holds the others up.
+        tokens = Queue(maxsize=self.queue_size * len(queues) + sum(workers))
+
+        def _put(queue, item):
+            while not stop.is_set():
+                try:
+                    queue.put(item, timeout=0.1)
+                    return True
+                except Full:
+                    pass
+            return False
+
+        def _fail(error):
+            errors.append(error)
+            stop.set()
+
+        def _feed():
+            try:
+                for item in enumerate(items):
+                    if not _put(tokens, None) or not _put(queues[0], item):
+                        return
+            except Exception as error:
+                _fail(error)
+                return
+            for _ in range(workers[0]):
+                _put(queues[0], done)
+
+        def _work(stage_index):
+            function = self.stages[stage_index][1]
+            while not stop.is_set():
+                try:
+                    item = queues[stage_index].get(timeout=0.1)
+                except Empty:
+                    continue
+                if item is done:
+                    # The last worker of a stage to finish tells the workers of the next stage.
+                    with lock:
+                        finished[stage_index] += 1
+                        last = finished[stage_index] == workers[stage_index]
+                    if last:
+                        for _ in range(workers[stage_index + 1]):
+                            _put(queues[stage_index + 1], done)
+                    return
+                index, value = item
+                with _stage(self.stages[stage_index][0]):
+                    try:
+                        result = function(value)
+                    except Exception as error:
+                        _fail(error)
+                        return
+                _put(queues[stage_index + 1], (index, result))
+
+        threads = [Thread(target=_feed)]
+        for stage_index in range(len(self.stages)):
+            threads += [Thread(target=_work, args=(stage_index,)) for _ in range(workers[stage_index])]
+        for thread in threads:
+            thread.daemon = True
+            thread.start()
+
+        pending = {}
+        next_index = 0
+        try:
+            while not stop.is_set():
+                try:
+                    item = queues[-1].get(timeout=0.1)
+                except Empty:
+                    continue
+                if item is done:
+                    break
+                pending[item[0]] = item[1]
+                while next_index in pending:
+                    result = pending.pop(next_index)
+                    next_index += 1
+                    tokens.get()
+                    yield result
+            if errors:
+                raise errors[0]
+        finally:
+            stop.set()
+
 
 class Jsrt(object):
-    """ Jsrt is a model to fetch all the images and augment them."""
+    """ Jsrt is a model to fetch all the images and augment them.
 
-    def __init__(self):
+    Args:
+        memory_budget   (int): Defaults to None (no limit). Bytes of pixel data that augment_images keeps in memory.
+                               Once past it the new images are written to disk and memory mapped, see JsrtSpill.
+        spill_directory (str): Defaults to None (the system temporary directory). Where images past memory_budget are
+                               written.
+
+    Examples:
+        jsrtdata = Jsrt(memory_budget=2 * 2 ** 30).load_images("./All247images/", lazy=True)
+        jsrtdata.augment_images(rotate_angles=[-2, -1, 1, 2])
+
+    """
+    # Columns of the metadata index, see Jsrt.metadata. Missing numbers are -1 and missing text is "".
+    METADATA_DTYPE = np.dtype([("has_nodule", "?"), ("subtlety", "<i4"), ("nodule_size", "<i4"), ("age", "<i4"),
+                               ("sex", "S8"), ("x", "<f8"), ("y", "<f8"), ("malignant_or_benign", "S16"),
+                               ("position", "S64"), ("diagnosis", "S64"), ("image_path", "S256")])
+    # Translations of 3 pixels in the cardinal and ordinal directions, see Jsrt.translate_stack.
+    TRANSLATIONS = [(dx * 3, dy * 3) for dy in (-1, 0, 1) for dx in (-1, 0, 1) if (dx, dy) != (0, 0)]
+
+    def __init__(self, memory_budget=None, spill_directory=None):
         self._images_dir = None
+        self._spill = None if memory_budget is None else JsrtSpill(memory_budget, spill_directory)
+        self._lazy = False
+        self._workers = 1
         self._has_nodule_image_list = None
         self._non_nodule_image_list = None
+        self._metadata = None
+        self._metadata_images = []
         self.test_dataset = None
         self.valid_dataset = None
         self.train_dataset = None
 
-    def load_images(self, images_path):
+    def load_images(self, images_path, lazy=False, workers=1):
+        """ This function loads all the images present in images_path along with their descriptions.
+
+        Args:
+            images_path (str): path to the directory/folder where all images are present.
+            lazy       (bool): Defaults to False. When True the images are memory mapped instead of being read into
+                               memory. See Also: JsrtImage.load_from_file
+            workers     (int): Defaults to 1. Number of threads used to read the image files concurrently.
+
+        """
         self._images_dir = images_path
-        self.__get_images_list()
-        self.add_descriptions_to_image()
+        self._lazy = lazy
+        self._workers = workers
+        with _stage("load_images"):
+            self.__get_images_list()
+            self.add_descriptions_to_image()
+            self.build_metadata_index()
+        if self._spill is not None:
+            self._spill.add(self._metadata_images)
+        return self
+
+    def build_metadata_index(self):
+        """ This function builds the metadata index of all the images, has-nodule images first and then non-nodule
+        images. It is built by load_images and augment_images, and it needs to be built again after changing the
+        images in place (for example with JsrtImage.horizontal_reflection).
+
+        See Also: Jsrt.metadata, Jsrt.query
+
+        """
+        def _number(value):
+            try:
+                return int(value)
+            except (TypeError, ValueError):
+                return -1
+
+        def _text(value):
+            return "" if value is None else str(value)
+
+        self._metadata_images = (self._has_nodule_image_list or []) + (self._non_nodule_image_list or [])
+        self._metadata = np.array([(image.image_type == "has nodule", _number(image._degree_of_subtlety),
+                                    _number(image._nodule_size), _number(image._age), _text(image._sex),
+                                    image.x, image.y, _text(image._malignant_or_benign), _text(image._position),
+                                    _text(image._diagnosis), _text(image.image_path))
+                                   for image in self._metadata_images], dtype=self.METADATA_DTYPE)
         return self
 
+    @property
+    def metadata(self):
+        """ The metadata index: a numpy structured array (see METADATA_DTYPE) with one row per image, has-nodule images
+        first and then non-nodule images. It is built again if the number of images changed since it was built. """
+        if self._metadata is None or \
+                len(self._metadata) != len(self._has_nodule_image_list or []) + len(self._non_nodule_image_list or []):
+            self.build_metadata_index()
+        return self._metadata
+
+    @staticmethod
+    def contains(column, text):
+        """ Gives a boolean mask of the rows of a text column of the metadata index that contain `text`. """
+        return np.char.find(column, text) >= 0
+
+    def query(self, condition):
+        """ This function gives the images whose metadata matches a condition. The condition is evaluated on whole
+        columns of the metadata index at once.
+
+        Args:
+            condition (function or array): A function taking the metadata index (see Jsrt.metadata) and giving a
+                                           boolean mask of its rows, or such a boolean mask.
+
+        Returns:
+            a list of JsrtImage objects.
+
+        Examples:
+            images = jsrtdata.query(lambda m: (m["subtlety"] <= 2) & (m["nodule_size"] > 15) &
+                                              Jsrt.contains(m["position"], "left"))
+
+        """
+        metadata = self.metadata
+        mask = condition(metadata) if callable(condition) else np.asarray(condition, dtype=bool)
+        return [self._metadata_images[index] for index in np.flatnonzero(mask)]
+
     def __get_images_list(self):
         images_list = [f for f in listdir(self._images_dir) if not f.startswith('.')]
         _has_nodule_files = []
@@ -314,26 +1822,52 @@ class Jsrt(object):
             else:
                 _non_nodule_files.append(filename)
         # Image objects are stored as list on _has_nodule_image_list and _non_nodule_image_list
-        self._has_nodule_image_list = self._load_images_from_file(_has_nodule_files, self._images_dir)
-        self._non_nodule_image_list = self._load_images_from_file(_non_nodule_files, self._images_dir)
+        self._has_nodule_image_list = self._load_images_from_file(_has_nodule_files, self._images_dir,
+                                                                  self._lazy, self._workers)
+        self._non_nodule_image_list = self._load_images_from_file(_non_nodule_files, self._images_dir,
+                                                                  self._lazy, self._workers)
         return self
 
     @staticmethod
-    def _load_images_from_file(filenames, directory):
+    def _load_images_from_file(filenames, directory, lazy=False, workers=1):
         """ This function load images (not image) located at directory/filename and creates an image object from it.
+        Files are read by a pool of `workers` threads when workers is more than 1, and the returned list keeps the
+        order of `filenames`.
+
         Args:
             filenames (list): a list of names of the image files.
             directory  (str): path to the directory/folder where all images are present
+            lazy      (bool): Defaults to False. When True the images are memory mapped.
+            workers    (int): Defaults to 1. Number of threads used to read the files.
+
         Returns:
             a list of JsrtImage objects
 
+        Raises:
+            IOError: If any of the files could not be loaded. The message lists every failed file with its error.
+
         """
-        images_list = []
-        for image_name in filenames:
-            img = JsrtImage()
-            img.load_from_file(directory + image_name)
-            images_list.append(img)
-        return images_list
+        def load(image_name):
+            try:
+                return JsrtImage().load_from_file(directory + image_name, lazy=lazy), None
+            except (IOError, ValueError) as error:
+                return None, error
+
+        if workers > 1:
+            pool = ThreadPool(workers)
+            try:
+                results = pool.map(load, filenames)
+            finally:
+                pool.close()
+                pool.join()
+        else:
+            results = [load(image_name) for image_name in filenames]
+
+        failures = [image_name + " (" + str(error) + ")"
+                    for image_name, (_, error) in zip(filenames, results) if error is not None]
+        if failures:
+            raise IOError("Could not load " + str(len(failures)) + " image(s): " + ", ".join(failures))
+        return [img for img, _ in results]
 
     def clean_csv_file(self, file_path, file_type):
         """ This function cleans the csv data present along with the image file. The data is removed of inappropriate
@@ -393,6 +1927,39 @@ class Jsrt(object):
         for image in self._non_nodule_image_list:
             image.add_description(csv_data[image.image_path], has_nodule=False)
 
+    @staticmethod
+    def crop_images(image_list, size, x, y, image_indices=None):
+        """ This function obtains cropped images (glimpses) of `size` from many images into one preallocated array.
+        The crop of center x[i], y[i] is taken from image_list[image_indices[i]].
+
+        See Also: JsrtImage.crop_batch
+
+        Args:
+            image_list     (list): A list of JsrtImage objects.
+            size            (int): glimpse/cropped image size
+            x             (array): x coordinates of the crop locations' (center/middle) positions.
+            y             (array): y coordinates of the crop locations' (center/middle) positions.
+            image_indices (array): Defaults to None. The index in image_list of the image of each crop. When None the
+                                   crops are taken one from each image in image_list.
+
+        Returns:
+            crops (array): numpy array of (len(x), size, size)
+
+        """
+        x = np.asarray(x, dtype=np.intp).ravel()
+        y = np.asarray(y, dtype=np.intp).ravel()
+        if image_indices is None:
+            image_indices = np.arange(len(image_list))
+        image_indices = np.asarray(image_indices, dtype=np.intp).ravel()
+        if len(image_indices) != len(x):
+            raise ValueError("Crop: image_indices, x and y must have the same length")
+        dtype = image_list[0].image.dtype.newbyteorder("=") if image_list else np.dtype(np.uint16)
+        crops = np.empty((len(x), size, size), dtype=dtype)
+        for image_index in np.unique(image_indices):
+            selected = np.flatnonzero(image_indices == image_index)
+            crops[selected] = image_list[image_index].crop_batch(size, x[selected], y[selected])
+        return crops
+
     def get_images(self, has_nodule=True, num_of_images=1):
         """ This function gives "num_of_images" number of JsrtImage objects in a list. The objects can be either all
         image with nodules or non-nodules.
@@ -412,73 +1979,304 @@ class Jsrt(object):
                 return -1
             return self._has_nodule_image_list[:num_of_images]
         else:
-            if len(self._has_nodule_image_list) < num_of_images:
+            if len(self._non_nodule_image_list) < num_of_images:
                 print "Number of images available is " + str(len(self._non_nodule_image_list))
                 return -1
             return self._non_nodule_image_list[:num_of_images]
 
     @staticmethod
-    def save_images(dataset, filename):
-        """ This function saves the jsrt image dataset into TFRecords format. Currently the function stores only the
-        image, its height, width, x and y coordinates of the nodule.
+    def _to_example(jsrtimage):
+        """ This function serializes a JsrtImage object into a tf.train.Example string, with the image (as big endian
+        16 bit integers) and all of its details. """
+        import tensorflow as tf
+
+        def _bytes_feature(value):
+            return tf.train.Feature(bytes_list=tf.train.BytesList(value=[value]))
+
+        def _int64_feature(value):
+            return tf.train.Feature(int64_list=tf.train.Int64List(value=[value]))
+
+        def _float_feature(value):
+            return tf.train.Feature(float_list=tf.train.FloatList(value=[value]))
+
+        def _text_feature(value):
+            return _bytes_feature("" if value is None else str(value))
+
+        example = tf.train.Example(features=tf.train.Features(feature={
+            'height': _int64_feature(jsrtimage.image_height),
+            'width': _int64_feature(jsrtimage.image_width),
+            'x': _int64_feature(int(round(jsrtimage.x))),
+            'y': _int64_feature(int(round(jsrtimage.y))),
+            'nodule_x': _float_feature(jsrtimage.x),
+            'nodule_y': _float_feature(jsrtimage.y),
+            'image_path': _text_feature(jsrtimage.image_path),
+            'image_type': _text_feature(jsrtimage._image_type),
+            'subtlety': _text_feature(jsrtimage._degree_of_subtlety),
+            'nodule_size': _int64_feature(-1 if jsrtimage._nodule_size is None else jsrtimage._nodule_size),
+            'age': _text_feature(jsrtimage._age),
+            'sex': _text_feature(jsrtimage._sex),
+            'pathology': _text_feature(jsrtimage._malignant_or_benign),
+            'position': _text_feature(jsrtimage._position),
+            'diagnosis': _text_feature(jsrtimage._diagnosis),
+            'image': _bytes_feature(np.asarray(jsrtimage.image, dtype=">i2").tostring())}))
+        return example.SerializeToString()
+
+    @staticmethod
+    def _from_example(string_record):
+        """ This function parses a tf.train.Example string written by _to_example (or by older versions of
+        save_images, which only stored the image, height, width, x and y) into a JsrtImage object. """
+        import tensorflow as tf
+
+        with _stage("tfrecord_read", len(string_record)):
+            return Jsrt._parse_example(tf, string_record)
+
+    @staticmethod
+    def _parse_example(tf, string_record):
+        example = tf.train.Example()
+        example.ParseFromString(string_record)
+        feature = example.features.feature
+        height = int(feature['height'].int64_list.value[0])
+        width = int(feature['width'].int64_list.value[0])
+        if 'nodule_x' in feature:
+            x = feature['nodule_x'].float_list.value[0]
+            y = feature['nodule_y'].float_list.value[0]
+        else:
+            x = int(feature['x'].int64_list.value[0])
+            y = int(feature['y'].int64_list.value[0])
+        img_string = feature['image'].bytes_list.value[0]
+        # The pixels are stored as big endian 16 bit integers, they are read as native uint16 like load_from_file.
+        image = np.clip(np.fromstring(img_string, dtype=">i2"), 0, None).astype(np.uint16).reshape((height, width))
+        img = JsrtImage()
+        img.load_image(image, height, width, x, y)
+        if 'image_type' in feature:
+            def _text(name):
+                return feature[name].bytes_list.value[0] or None
+
+            img.image_path = _text('image_path')
+            img.image_type = _text('image_type')
+            img._degree_of_subtlety = _text('subtlety')
+            nodule_size = int(feature['nodule_size'].int64_list.value[0])
+            img._nodule_size = nodule_size if nodule_size >= 0 else None
+            img._age = _text('age')
+            if img._age is not None and img.image_type == "has nodule":
+                img._age = int(img._age)
+            img._sex = _text('sex')
+            img._malignant_or_benign = _text('pathology')
+            img._position = _text('position')
+            img._diagnosis = _text('diagnosis')
+        return img
+
+    @staticmethod
+    def _compression_options(compression):
+        """ Gives the tf.python_io.TFRecordOptions for compression ("GZIP", "ZLIB" or None). """
+        import tensorflow as tf
+
+        if compression is None:
+            return None
+        return tf.python_io.TFRecordOptions(getattr(tf.python_io.TFRecordCompressionType, compression))
+
+    def get_random_images(self, num_of_images=1, has_nodule=None, seed=None):
+        """ This function gives "num_of_images" number of JsrtImage objects picked at random (without repetition).
 
         Args:
-            dataset (list): A list of JsrtImage objects to be stored in tfrecords format.
-            filename (str): name of the tfrecords file.
+            num_of_images (int): Defaults to 1. The required number of images is given.
+            has_nodule   (bool): Defaults to None. True picks only images with nodules, False only images without
+                                 nodules and None picks from a mix of both.
+            seed          (int): Defaults to None. Seed of the random number generator.
 
-        Examples:
-            jsrtdata = Jsrt().read_images("./All247images/")
-            train_images = jsrtdata.get_images(num_of_images=50)
-            jsrtdata.save_images(train_images, "train_images.tfrecords")
+        Returns:
+            a list of JsrtImage objects. Total objects will be num_of_images.
 
         """
-        if dataset is None:
-            raise ValueError('None obtained as dataset value')
+        if has_nodule is True:
+            image_list = self._has_nodule_image_list
+        elif has_nodule is False:
+            image_list = self._non_nodule_image_list
+        else:
+            image_list = self._has_nodule_image_list + self._non_nodule_image_list
+        if len(image_list) < num_of_images:
+            raise ValueError("Number of images available is " + str(len(image_list)))
+        indices = np.random.RandomState(seed).choice(len(image_list), num_of_images, replace=False)
+        return [image_list[index] for index in indices]
+
+    def split(self, train=0.7, valid=0.1, test=0.2, seed=None):
+        """ This function splits the loaded (and augmented) images into train_dataset, valid_dataset and test_dataset.
+        Images are split by source image: an image and all the images augmented from it (which keep its image_path)
+        always go to the same split. Source images are stratified on nodule presence, subtlety and malignancy, so that
+        every split gets about its fraction of each kind. The splits are JsrtSplit views of the images of the
+        metadata index (see Jsrt.metadata), so splitting costs the size of the index and not of the images.
 
-        writer = tf.python_io.TFRecordWriter(filename)
+        Args:
+            train (float): Defaults to 0.7. Fraction of the source images in train_dataset.
+            valid (float): Defaults to 0.1. Fraction of the source images in valid_dataset.
+            test  (float): Defaults to 0.2. Fraction of the source images in test_dataset.
+            seed    (int): Defaults to None. Seed of the random number generator.
 
-        def _bytes_feature(value):
-            return tf.train.Feature(bytes_list=tf.train.BytesList(value=[value]))
+        Examples:
+            jsrtdata = Jsrt().load_images("./All247images/", lazy=True)
+            jsrtdata.augment_images(rotate_angles=[1, 2])
+            jsrtdata.split(train=0.7, valid=0.1, test=0.2, seed=0)
+            jsrtdata.save_train_dataset("train_images.tfrecords")
 
-        def _int64_feature(value):
-            return tf.train.Feature(int64_list=tf.train.Int64List(value=[value]))
+        """
+        fractions = np.array([train, valid, test], dtype=np.float64)
+        if (fractions < 0).any() or fractions.sum() <= 0:
+            raise ValueError("Split: invalid fractions")
+        fractions /= fractions.sum()
+        metadata = self.metadata
+        images = self._metadata_images
+
+        # Images without a path (such as images read back from old tfrecords files) are grouped by the image they were
+        # made from in memory instead.
+        keys = metadata["image_path"].astype(object)
+        for row in np.flatnonzero(metadata["image_path"] == ""):
+            root = images[row]
+            while root.parent is not None:
+                root = root.parent
+            keys[row] = "\0%d" % id(root)
+        _, first_rows, group_of_row = np.unique(keys, return_index=True, return_inverse=True)
+
+        strata = {}
+        for group, row in enumerate(first_rows):
+            stratum = (metadata["has_nodule"][row], metadata["subtlety"][row], metadata["malignant_or_benign"][row])
+            strata.setdefault(stratum, []).append(group)
+        # The groups of every stratum, shuffled, are dealt in turn to the split furthest below its fraction. The deal
+        # goes on from one stratum to the next, so strata too small to split (one group) still add up to the fractions.
+        rng = np.random.RandomState(seed)
+        split_of_group = np.empty(len(first_rows), dtype=np.intp)
+        counts = np.zeros(len(fractions))
+        for stratum in sorted(strata):
+            for group in rng.permutation(strata[stratum]):
+                split_index = np.argmax(fractions * (counts.sum() + 1) - counts)
+                counts[split_index] += 1
+                split_of_group[group] = split_index
+
+        split_of_row = split_of_group[group_of_row]
+        self.train_dataset, self.valid_dataset, self.test_dataset = \
+            [JsrtSplit(images, np.flatnonzero(split_of_row == split_index)) for split_index in range(3)]
+        return self
 
-        for jsrtimage in dataset:
-            img = jsrtimage.image.tostring()
-            height = jsrtimage.image_height
-            width = jsrtimage.image_width
-            x = jsrtimage.x
-            y = jsrtimage.y
+    @staticmethod
+    def save_images(dataset, filename, file_format="tfrecords", shards=1, shard_size=None, compression=None,
+                    workers=1):
+        """ This function saves the jsrt image dataset into TFRecords format. The function stores the image, its
+        height, width, x and y coordinates of the nodule and all the other details of the image (see
+        JsrtImage.get_all_details).
 
-            example = tf.train.Example(features=tf.train.Features(feature={
-                'height': _int64_feature(height),
-                'width': _int64_feature(width),
-                'x': _int64_feature(x),
-                'y': _int64_feature(y),
-                'image': _bytes_feature(img)}))
+        Args:
+            dataset (list): A list of JsrtImage objects to be stored in tfrecords format.
+            filename (str): name of the tfrecords file.
+            file_format (str): Defaults to "tfrecords". With "native" the dataset is saved as a JsrtDataset file
+                               instead, which keeps all the image details, and with "packed" as a JsrtDataset file
+                               of 12 bit pixels. See Also: JsrtDataset
+            shards (int): Defaults to 1. Number of tfrecords files to write. With more than one shard the files are
+                          named filename-00000-of-0000N and image k goes to shard k % shards.
+            shard_size (int): Defaults to None. Target size of a shard in bytes (uncompressed). When given, and dataset
+                              is a list, the number of shards is worked out from it instead of `shards`.
+            compression (str): Defaults to None. "GZIP" or "ZLIB" to compress the tfrecords files.
+            workers (int): Defaults to 1. Number of threads writing the shards in parallel.
 
-            writer.write(example.SerializeToString())
-        writer.close()
+        Returns:
+            filenames (list): names of the tfrecords files written.
 
-    def save_test_dataset(self, filename):
-        self.save_images(self.test_dataset, filename)
+        Examples:
+            jsrtdata = Jsrt().read_images("./All247images/")
+            train_images = jsrtdata.get_images(num_of_images=50)
+            jsrtdata.save_images(train_images, "train_images.tfrecords")
+            jsrtdata.save_images(train_images, "train_images.tfrecords", shards=4, compression="GZIP", workers=4)
 
-    def save_train_dataset(self, filename):
-        self.save_images(self.train_dataset, filename)
+        """
+        if file_format in ("native", "packed"):
+            JsrtDataset.save(dataset, filename, packed=file_format == "packed")
+            return [filename]
+        if dataset is None:
+            raise ValueError('None obtained as dataset value')
+        import tensorflow as tf
 
-    def save_valid_dataset(self, filename):
-        self.save_images(self.valid_dataset, filename)
+        if shard_size is not None and hasattr(dataset, "__len__") and len(dataset) > 0:
+            shards = int(math.ceil(len(dataset) * float(dataset[0].image.nbytes) / shard_size))
+        shards = max(1, shards)
+        if shards == 1:
+            filenames = [filename]
+        else:
+            filenames = [filename + "-%05d-of-%05d" % (shard, shards) for shard in range(shards)]
+        options = Jsrt._compression_options(compression)
+        writers = [tf.python_io.TFRecordWriter(name, options=options) for name in filenames]
+
+        def _write(writer, jsrtimage):
+            with _stage("tfrecord_write") as stage:
+                record = Jsrt._to_example(jsrtimage)
+                writer.write(record)
+                stage.nbytes = len(record)
+
+        try:
+            if workers <= 1:
+                for index, jsrtimage in enumerate(dataset):
+                    _write(writers[index % shards], jsrtimage)
+            else:
+                # Every thread writes its own shards, fed through a small queue to keep memory bounded.
+                threads_count = min(workers, shards)
+                queues = [Queue(maxsize=2) for _ in range(threads_count)]
+                errors = []
+
+                def _write_shards(queue):
+                    while True:
+                        item = queue.get()
+                        if item is None:
+                            return
+                        if not errors:
+                            try:
+                                _write(writers[item[0]], item[1])
+                            except Exception as error:
+                                errors.append(error)
+
+                threads = [Thread(target=_write_shards, args=(queue,)) for queue in queues]
+                for thread in threads:
+                    thread.start()
+                try:
+                    for index, jsrtimage in enumerate(dataset):
+                        if errors:
+                            break
+                        queues[(index % shards) % threads_count].put((index % shards, jsrtimage))
+                finally:
+                    for queue in queues:
+                        queue.put(None)
+                    for thread in threads:
+                        thread.join()
+                if errors:
+                    raise errors[0]
+        finally:
+            for writer in writers:
+                writer.close()
+        return filenames
+
+    def save_test_dataset(self, filename, file_format="tfrecords"):
+        return self.save_images(self.test_dataset, filename, file_format)
+
+    def save_train_dataset(self, filename, file_format="tfrecords"):
+        return self.save_images(self.train_dataset, filename, file_format)
+
+    def save_valid_dataset(self, filename, file_format="tfrecords"):
+        return self.save_images(self.valid_dataset, filename, file_format)
 
     @staticmethod
-    def read_images(filename):
-        """ This function reads the JsrtImage objects stored in TFrecords file. Currently function only reads the
-        image, its height, width, x and y coordinates of the nodule.
+    def read_images(filename, file_format="tfrecords", compression=None, lazy=False):
+        """ This function reads the JsrtImage objects stored in TFrecords file. The function reads the image, its
+        height, width, x and y coordinates of the nodule, and its other details when the file has them.
 
         Args:
             filename (str): Path to the tfrecords file
+            file_format (str): Defaults to "tfrecords". With "native" (or "packed") the file is opened as a
+                               JsrtDataset, which reads no pixels up front and gives images that are views into the
+                               file (or unpacked from it).
+            compression (str): Defaults to None. "GZIP" or "ZLIB" for compressed tfrecords files.
+            lazy (bool): Defaults to False. When True a JsrtRecordFile is returned instead, which reads the images only
+                         as they are used, with background prefetch and random access. filename can then also be a
+                         list of shard filenames. See Also: JsrtRecordFile
 
         Returns:
             jsrt_image_list (list): A list of JsrtImage objects having image, height, width, x and y coordinate set up.
+            (a JsrtDataset for the "native" file_format and a JsrtRecordFile when lazy is True)
 
         Examples:
             jsrtdata = Jsrt().load_images("./All247images/")
@@ -496,41 +2294,29 @@ class Jsrt(object):
             You should get 5 True statements as result which confirms that values are same.
 
         """
-        records = tf.python_io.tf_record_iterator(path=filename)
+        if file_format in ("native", "packed"):
+            return JsrtDataset(filename)
+        if lazy is True:
+            return JsrtRecordFile(filename, compression)
+        import tensorflow as tf
+
+        records = tf.python_io.tf_record_iterator(path=filename, options=Jsrt._compression_options(compression))
         jsrt_image_list = []
         for string_record in records:
-            example = tf.train.Example()
-            example.ParseFromString(string_record)
-            height = int(example.features.feature['height']
-                         .int64_list
-                         .value[0])
-
-            width = int(example.features.feature['width']
-                        .int64_list
-                        .value[0])
-            x = int(example.features.feature['x'].int64_list.value[0])
-            y = int(example.features.feature['y'].int64_list.value[0])
-            img_string = (example.features.feature['image']
-                          .bytes_list
-                          .value[0])
-            image = np.fromstring(img_string, dtype=">i2").reshape((height, width))
-            image.shape = (height, width)
-            img = JsrtImage()
-            img.load_image(image, height, width, x, y)
-            jsrt_image_list.append(img)
+            jsrt_image_list.append(Jsrt._from_example(string_record))
         return jsrt_image_list
 
-    def read_test_dataset(self, filename):
-        self.test_dataset = self.read_images(filename)
+    def read_test_dataset(self, filename, file_format="tfrecords", compression=None, lazy=False):
+        self.test_dataset = self.read_images(filename, file_format, compression, lazy)
 
-    def read_train_dataset(self, filename):
-        self.train_dataset = self.read_images(filename)
+    def read_train_dataset(self, filename, file_format="tfrecords", compression=None, lazy=False):
+        self.train_dataset = self.read_images(filename, file_format, compression, lazy)
 
-    def read_valid_dataset(self, filename):
-        self.valid_dataset = self.read_images(filename)
+    def read_valid_dataset(self, filename, file_format="tfrecords", compression=None, lazy=False):
+        self.valid_dataset = self.read_images(filename, file_format, compression, lazy)
 
     @staticmethod
-    def horizontally_reflect_images(image_list):
+    def horizontally_reflect_images(image_list, cache=None, spill=None):
         """ This function does a horizontal flip of the images present in the image_list given and also changes
         the x coordinate of the lung nodule in the image appropriately (if present).
 
@@ -538,6 +2324,8 @@ class Jsrt(object):
 
         Args:
             image_list (list): A list of JsrtImage objects.
+            cache (JsrtCache): Defaults to None. When given, flipped images are read from or stored in the cache.
+            spill (JsrtSpill): Defaults to None. When given, every flipped image is admitted to it as it is made.
 
         Returns:
             new_image_list (list): A list of JsrtImage objects that are horizontally flipped.
@@ -545,21 +2333,37 @@ class Jsrt(object):
         """
         new_image_list = []
         for image in image_list:
-            new_image = copy.copy(image)
-            new_image.horizontal_reflection()
+            new_image = None if cache is None else cache.get(image, image._transforms + (("reflect",),))
+            if new_image is None:
+                new_image = image.new_child()
+                new_image.horizontal_reflection()
+                if cache is not None:
+                    cache.put(new_image)
+            if spill is not None:
+                spill.admit(new_image)
             new_image_list.append(new_image)
         return new_image_list
 
     @staticmethod
-    def rotate_image(image_list, rotate_angles):
+    def rotate_image(image_list, rotate_angles, order=3, cache=None, spill=None, chunk_bytes=256 * 2 ** 20):
         """ This function does a rotation of the images present in the image_list with all angles given in rotate_angles
         and it also changes the x coordinate and y coordinate of the lung nodule in the image appropriately.
 
-        See Also: JsrtImage.rotate
+        Without a spill, the images that are not in the cache are rotated a chunk at a time by the batch engine of
+        rotate_stack, which gives the same pixels as JsrtImage.rotate, faster but with more memory: a float64 copy of
+        every image of the chunk and its rotations (about 50 MB per 2048x2048 image for 2 angles) are held together
+        within chunk_bytes, plus the sparse matrix of rotate_stack (up to about 150 MB at order 3). With a spill the
+        images are rotated one at a time, so that the memory stays within its budget.
+
+        See Also: JsrtImage.rotate, Jsrt.rotate_stack
 
         Args:
         image_list (list): A list of all JsrtImage objects.
         rotate_angles (list): A list of angles through which images in `image_list` are to be rotated.
+        order (int): Defaults to 3. The order of the spline interpolation. See Also: JsrtImage.rotate
+        cache (JsrtCache): Defaults to None. When given, rotated images are read from or stored in the cache.
+        spill (JsrtSpill): Defaults to None. When given, every rotated image is admitted to it as it is made.
+        chunk_bytes (int): Defaults to 256 MB. Bound on the memory of the images rotated together, see above.
 
         Returns:
             rotated_images_list (list): It is a list consisting of list of images rotated in given angle.
@@ -568,17 +2372,350 @@ class Jsrt(object):
                 [[JsrtImage objects rotated by 1°],[JsrtImage objects rotated by 2°],[JsrtImage objects rotated by -3°]]
 
         """
-        rotated_images_list = []
-        for angle in rotate_angles:
-            rotated_images_on_each_angle = []
-            for image in image_list:
-                new_image = copy.copy(image)
-                new_image.rotate(angle)
-                rotated_images_on_each_angle.append(new_image)
-            rotated_images_list.append(rotated_images_on_each_angle)
+        rotated_images_list = [[None] * len(image_list) for _ in rotate_angles]
+        missing = []
+        for index, image in enumerate(image_list):
+            for i, angle in enumerate(rotate_angles):
+                if cache is not None:
+                    new_image = cache.get(image, image._transforms + (("rotate", angle, order),))
+                    if new_image is not None:
+                        if spill is not None:
+                            spill.admit(new_image)
+                        rotated_images_list[i][index] = new_image
+            if any(rotated_images[index] is None for rotated_images in rotated_images_list):
+                missing.append(index)
+
+        chunk_size = 1
+        if spill is None and order in (0, 1, 3) and missing:
+            image = image_list[missing[0]].image
+            height, width = image.shape
+            image_bytes = 8 * (height + 3) * (width + 3) + len(rotate_angles) * image.nbytes
+            chunk_size = max(1, chunk_bytes // image_bytes)
+        for start in range(0, len(missing), chunk_size):
+            chunk = missing[start:start + chunk_size]
+            rotated = None
+            shapes = set(image_list[index].image.shape for index in chunk)
+            if len(chunk) > 1 and len(shapes) == 1:
+                rotated, _ = Jsrt.rotate_stack(np.array([image_list[index].image for index in chunk]), rotate_angles,
+                                               order=order, chunk_bytes=chunk_bytes)
+            for i, angle in enumerate(rotate_angles):
+                for j, index in enumerate(chunk):
+                    if rotated_images_list[i][index] is not None:
+                        continue
+                    image = image_list[index]
+                    new_image = image.new_child()
+                    if rotated is None:
+                        new_image.rotate(angle, order=order)
+                    else:
+                        new_image._rotate_nodule(angle)
+                        new_image._transforms += (("rotate", angle, order),)
+                        # a copy, so that spilling or dropping the image frees its memory
+                        new_image.image = rotated[i, j, :2048, :2048].copy()
+                        logger.debug("%s was rotated by %s degrees.", new_image.image_path, angle)
+                    if cache is not None:
+                        cache.put(new_image)
+                    if spill is not None:
+                        spill.admit(new_image)
+                    rotated_images_list[i][index] = new_image
         return rotated_images_list
 
-    def augment_images(self, horizontal_reflection=True, rotate=True, rotate_angles=[1, 2]):
+    @staticmethod
+    def rotate_stack(images, rotate_angles, order=1, coordinates=None, chunk_bytes=256 * 2 ** 20):
+        """ This function rotates a stack of images by every angle in rotate_angles. For every angle the input
+        coordinates, spline taps and weights of all the output pixels are computed once, as a sparse matrix, and
+        applied to a chunk of images at a time, and the cubic spline prefilter of a chunk is done once for all the
+        angles. The pixels are the same as JsrtImage.rotate gives with the same order. The nodule coordinates of all
+        the images are transformed together for each angle.
+
+        See Also: JsrtImage.rotate, JsrtImage.get_rotation_matrix
+
+        Args:
+            images         (array): An array of shape (N, height, width), or a single (height, width) image.
+            rotate_angles   (list): A list of angles (in degrees) through which the images are to be rotated.
+            order            (int): Defaults to 1 (bilinear). The order of the spline interpolation. 0 (nearest), 1
+                                    and 3 use the batch engine, other orders rotate the images one at a time.
+            coordinates    (array): Defaults to None. An array of shape (N, 2) with the (x, y) nodule coordinates of
+                                    each image. Rows of non-nodule images (x and y equal to -1) are left unchanged.
+            chunk_bytes      (int): Defaults to 256 MB. Bound on the float64 copies (about 34 MB for a 2048x2048
+                                    image) of the images resampled together, at least one image is. The sparse
+                                    matrix of 256 output rows and its construction come on top of it (up to about
+                                    150 MB at order 3 for 2048 wide images), and so does the returned array.
+
+        Returns:
+            rotated, new_coordinates (array, array): rotated is an array of shape (len(rotate_angles), N, height,
+            width) in native byte order and new_coordinates is an array of shape (len(rotate_angles), N, 2), or None
+            when coordinates is None.
+
+        Examples:
+            nodule_images = jsrtdata.get_images(num_of_images=10, has_nodule=True)
+            stack = np.array([image.image for image in nodule_images])
+            rotated, coordinates = Jsrt.rotate_stack(stack, [1, 2], order=1,
+                                                     coordinates=[[image.x, image.y] for image in nodule_images])
+
+        """
+        images = np.asarray(images)
+        if images.ndim == 2:
+            images = images[np.newaxis]
+        rotated = np.empty((len(rotate_angles),) + images.shape, dtype=images.dtype.newbyteorder("="))
+
+        new_coordinates = None
+        if coordinates is not None:
+            coordinates = np.asarray(coordinates, dtype=np.float64).reshape((-1, 2))
+            has_nodule = (coordinates != -1).any(axis=1)
+            new_coordinates = np.repeat(coordinates[np.newaxis], len(rotate_angles), axis=0)
+
+        transforms = [JsrtImage.get_rotation_matrix(images.shape[1:], angle) for angle in rotate_angles]
+        with _stage("rotate_stack"):
+            if order in (0, 1, 3):
+                chunk_size = max(1, chunk_bytes // (8 * (images.shape[1] + 3) * (images.shape[2] + 3)))
+                for start in range(0, len(images), chunk_size):
+                    _resample_stack(images[start:start + chunk_size], transforms, order,
+                                    rotated[:, start:start + chunk_size])
+            else:
+                for i, (offset, matrix) in enumerate(transforms):
+                    for j in range(len(images)):
+                        ndimage.affine_transform(images[j], matrix, offset, output=rotated[i, j], order=order,
+                                                 mode="nearest")
+        if new_coordinates is not None:
+            for i, (offset, matrix) in enumerate(transforms):
+                new_coordinates[i, has_nodule] = np.dot(coordinates[has_nodule], matrix.T) + offset
+        return rotated, new_coordinates
+
+    @staticmethod
+    def translate_stack(images, shifts=TRANSLATIONS, coordinates=None):
+        """ This function translates a stack of images by every (dx, dy) shift in shifts. The stack is padded once by
+        repeating its edge pixels, and each translation is a strided view of the padded stack, so no resampling is
+        done.
+
+        Args:
+            images      (array): An array of shape (N, height, width), or a single (height, width) image.
+            shifts       (list): Defaults to Jsrt.TRANSLATIONS (3 pixels in the 8 cardinal and ordinal directions). A
+                                 list of integer (dx, dy) shifts, a positive dx moves the image right and a positive dy
+                                 moves it down.
+            coordinates (array): Defaults to None. An array of shape (N, 2) with the (x, y) nodule coordinates of each
+                                 image. Rows of non-nodule images (x and y equal to -1) are left unchanged.
+
+        Returns:
+            translated, new_coordinates (array, array): translated is an array of shape (len(shifts), N, height, width)
+            and new_coordinates is an array of shape (len(shifts), N, 2), or None when coordinates is None.
+
+        """
+        images = np.asarray(images)
+        if images.ndim == 2:
+            images = images[np.newaxis]
+        shifts = np.asarray(shifts, dtype=np.intp).reshape((-1, 2))
+        height, width = images.shape[1:]
+        margin = int(np.abs(shifts).max()) if len(shifts) else 0
+        padded = np.pad(images, ((0, 0), (margin, margin), (margin, margin)), mode="edge")
+        translated = np.empty((len(shifts),) + images.shape, dtype=images.dtype.newbyteorder("="))
+        for index, (dx, dy) in enumerate(shifts):
+            translated[index] = padded[:, margin - dy: margin - dy + height, margin - dx: margin - dx + width]
+
+        new_coordinates = None
+        if coordinates is not None:
+            coordinates = np.asarray(coordinates, dtype=np.float64).reshape((-1, 2))
+            has_nodule = (coordinates != -1).any(axis=1)
+            new_coordinates = np.repeat(coordinates[np.newaxis], len(shifts), axis=0)
+            new_coordinates[:, has_nodule] += shifts[:, np.newaxis, :]
+        return translated, new_coordinates
+
+    @staticmethod
+    def pixel_spread_stack(images, seed=None):
+        """ This function does a pixel spread of a stack of images: each pixel takes the value of one of its 8
+        adjacent pixels picked at random (edge pixels repeat the edge). The nodule coordinates do not change.
+
+        Args:
+            images (array): An array of shape (N, height, width), or a single (height, width) image.
+            seed     (int): Defaults to None. Seed of the random number generator.
+
+        Returns:
+            spread (array): An array of the shape of images.
+
+        """
+        images = np.asarray(images)
+        height, width = images.shape[-2:]
+        padded = np.pad(images, [(0, 0)] * (images.ndim - 2) + [(1, 1), (1, 1)], mode="edge")
+        neighbours = [(dx, dy) for dy in (-1, 0, 1) for dx in (-1, 0, 1) if (dx, dy) != (0, 0)]
+        choice = np.random.RandomState(seed).randint(len(neighbours), size=images.shape).astype(np.int8)
+        spread = np.empty(images.shape, dtype=images.dtype.newbyteorder("="))
+        for index, (dx, dy) in enumerate(neighbours):
+            picked = choice == index
+            spread[picked] = padded[..., 1 + dy: 1 + dy + height, 1 + dx: 1 + dx + width][picked]
+        return spread
+
+    @staticmethod
+    def median_denoise_stack(images, size=3, rank_offset=1):
+        """ This function reduces the noise of a stack of images by replacing each pixel with the value just after (or
+        before) the median value of its size x size neighbourhood, using scipy.ndimage's rank filter over the whole
+        stack at once. The nodule coordinates do not change.
+
+        Args:
+            images      (array): An array of shape (N, height, width), or a single (height, width) image.
+            size          (int): Defaults to 3. Side of the neighbourhood.
+            rank_offset   (int): Defaults to 1. 1 takes the value just after the median, -1 the value just before it.
+
+        Returns:
+            denoised (array): An array of the shape of images.
+
+        """
+        images = np.asarray(images)
+        rank = min(max(size * size // 2 + rank_offset, 0), size * size - 1)
+        return ndimage.rank_filter(images, rank, size=(1,) * (images.ndim - 2) + (size, size), mode="nearest")
+
+    @staticmethod
+    def add_noise_stack(images, sigma=20.0, seed=None, maximum=4095):
+        """ This function adds random gaussian noise to a stack of images, keeping the values in [0, maximum] (the
+        JSRT images are 12 bit). The nodule coordinates do not change.
+
+        Args:
+            images (array): An array of shape (N, height, width), or a single (height, width) image.
+            sigma  (float): Defaults to 20. Standard deviation of the noise.
+            seed     (int): Defaults to None. Seed of the random number generator.
+            maximum  (int): Defaults to 4095. Largest pixel value.
+
+        Returns:
+            noisy (array): An array of the shape of images.
+
+        """
+        images = np.asarray(images)
+        noise = np.random.RandomState(seed).normal(0, sigma, size=images.shape).astype(np.float32)
+        noisy = np.clip(np.rint(images + noise), 0, maximum)
+        return noisy.astype(images.dtype.newbyteorder("="))
+
+    def iter_augmented(self, horizontal_reflection=True, rotate=True, rotate_angles=[1, 2], order=3, cache=None):
+        """ This function is a generator version of augment_images. It yields the same augmented JsrtImage objects
+        one at a time, computing each child only when it is requested, and it does not add them to the loaded image
+        lists. So memory use stays constant whatever the number of augmentations is.
+
+        Images are yielded source by source, non-nodule images first and then has-nodule images. For each source
+        image the order is: its horizontal reflection, then for each angle in rotate_angles the rotated source image
+        followed by the rotated reflection.
+
+        Args:
+            horizontal_reflection (bool): Defaults to True. Yields the horizontal reflection of every loaded image.
+            rotate                (bool): Defaults to True. Yields the rotations of every loaded image (and of its
+                                          reflection when horizontal_reflection is True).
+            rotate_angles         (list): Defaults to [1, 2]. The angles (in degrees) through which images are rotated.
+            order                  (int): Defaults to 3. The order of the spline interpolation used for rotation.
+            cache            (JsrtCache): Defaults to None. When given, images are read from or stored in the cache.
+
+        Examples:
+            jsrtdata = Jsrt().load_images("./All247images/", lazy=True)
+            jsrtdata.save_images(jsrtdata.iter_augmented(rotate_angles=[1, 2, -1]), "augmented.tfrecords")
+
+        """
+        for image in self._non_nodule_image_list + self._has_nodule_image_list:
+            sources = [image]
+            if horizontal_reflection is True:
+                reflected_image = self.horizontally_reflect_images([image], cache=cache)[0]
+                yield reflected_image
+                sources.append(reflected_image)
+            if rotate is True:
+                for angle in rotate_angles:
+                    for source in sources:
+                        yield self.rotate_image([source], [angle], order=order, cache=cache)[0][0]
+
+    @staticmethod
+    def _share_images(image_list):
+        """ This function makes the images in image_list readable by other processes through np.memmap. Images loaded
+        with lazy=True are already backed by their .IMG file, the others are written once into a temporary file.
+
+        Args:
+            image_list (list): A list of JsrtImage objects.
+
+        Returns:
+            sources, temporary_filename (list, str): sources is a list of (filename, dtype, shape, offset) for each
+            image and temporary_filename is the file to remove when done with it (None if it was not needed).
+
+        """
+        sources = []
+        temporary_filename = None
+        temporary_file = None
+        try:
+            for image in image_list:
+                raster = image.image
+                if isinstance(raster, np.memmap) and isinstance(raster.base, mmap.mmap):
+                    sources.append((raster.filename, raster.dtype.str, raster.shape, raster.offset))
+                    continue
+                if temporary_file is None:
+                    handle, temporary_filename = mkstemp(suffix=".jsrt")
+                    close(handle)
+                    temporary_file = open(temporary_filename, "wb")
+                sources.append((temporary_filename, raster.dtype.str, raster.shape, temporary_file.tell()))
+                temporary_file.write(np.ascontiguousarray(raster).tostring())
+        finally:
+            if temporary_file is not None:
+                temporary_file.close()
+        return sources, temporary_filename
+
+    @staticmethod
+    def _augment_in_processes(image_lists, horizontal_reflection, rotate, rotate_angles, order, processes, cache=None,
+                              spill=None):
+        """ This function is the process pool version of the reflection and rotation done in augment_images. The new
+        images of every list in image_lists are computed by `processes` workers and come back in the same order, with
+        the same nodule coordinates and positions, as with horizontally_reflect_images and rotate_image.
+
+        Args:
+            image_lists (list): A list of lists of JsrtImage objects.
+            See augment_images for the other arguments.
+
+        Returns:
+            new_image_lists (list): The lists in image_lists, each extended with its new images.
+
+        """
+        tasks = []
+        for list_index, image_list in enumerate(image_lists):
+            reflections = [False, True] if horizontal_reflection is True else [False]
+            if horizontal_reflection is True:
+                tasks += [(list_index, image_index, True, None) for image_index in range(len(image_list))]
+            if rotate is True:
+                for angle in rotate_angles:
+                    for reflect in reflections:
+                        tasks += [(list_index, image_index, reflect, angle) for image_index in range(len(image_list))]
+
+        cached_images = [None] * len(tasks)
+        if cache is not None:
+            for task_index, (list_index, image_index, reflect, angle) in enumerate(tasks):
+                image = image_lists[list_index][image_index]
+                transforms = image._transforms + ((("reflect",),) if reflect is True else ()) +\
+                    ((("rotate", angle, order),) if angle is not None else ())
+                cached_images[task_index] = cache.get(image, transforms)
+
+        all_images = [image for image_list in image_lists for image in image_list]
+        first_index = np.cumsum([0] + [len(image_list) for image_list in image_lists])
+        sources, temporary_filename = Jsrt._share_images(all_images)
+        jobs = [sources[first_index[list_index] + image_index] + (reflect, angle, order)
+                for (list_index, image_index, reflect, angle), cached_image in zip(tasks, cached_images)
+                if cached_image is None]
+
+        pool = Pool(processes)
+        try:
+            results = pool.imap(_augment_worker, jobs)
+            new_image_lists = [list(image_list) for image_list in image_lists]
+            for (list_index, image_index, reflect, angle), new_image in zip(tasks, cached_images):
+                if new_image is None:
+                    new_image = image_lists[list_index][image_index].new_child()
+                    if reflect is True:
+                        new_image._reflect_nodule()
+                        new_image._transforms += (("reflect",),)
+                    if angle is not None:
+                        new_image._rotate_nodule(angle)
+                        new_image._transforms += (("rotate", angle, order),)
+                    new_image.image = next(results)
+                    if cache is not None:
+                        cache.put(new_image)
+                if spill is not None:
+                    spill.admit(new_image)
+                new_image_lists[list_index].append(new_image)
+        finally:
+            pool.close()
+            pool.join()
+            if temporary_filename is not None:
+                remove(temporary_filename)
+        return new_image_lists
+
+    def augment_images(self, horizontal_reflection=True, rotate=True, rotate_angles=[1, 2], order=3, processes=1,
+                       cache=None):
         """ This function attempts to augment Jsrt images (to increase the dataset) by applying a number of image
         transformations.
             1. Horizontal reflection. To do horizontal refection of the non-nodule and has-nodules images loaded
@@ -598,25 +2735,51 @@ class Jsrt(object):
             _non_nodule_image_list and _has_nodule_image_list will be rotated. A positive degree means counter-clockwise
             rotation. Default rotation angles are 1° and 2°.
 
+            order (int): Defaults to 3. The order of the spline interpolation used for rotation.
+            See Also: JsrtImage.rotate
+
+            Without a memory_budget the rotations are done in chunks of images that take up to about 256 MB, plus
+            up to about 150 MB at order 3, on top of the new images. See Also: rotate_image
+
+            processes (int): Defaults to 1. When more than 1, the images are augmented by a pool of `processes`
+            worker processes. The source images are shared with the workers through np.memmap rather than pickled,
+            and the result is the same as with a single process.
+
+            cache (JsrtCache): Defaults to None. When given, augmented images are read from the cache when present and
+            stored in it otherwise. See Also: JsrtCache
+
+            The new images are kept within the memory_budget given to Jsrt, see JsrtSpill.
+
         """
-        if horizontal_reflection is True:
-            new_non_nodule_image_list = self.horizontally_reflect_images(self._non_nodule_image_list)
-            self._non_nodule_image_list += new_non_nodule_image_list
-            new_has_nodule_image_list = self.horizontally_reflect_images(self._has_nodule_image_list)
-            self._has_nodule_image_list += new_has_nodule_image_list
-            print "Total images after horizontal flip in non nodule case is " +\
-                  str(len(self._non_nodule_image_list)) +\
-                  " and has nodule case is " +\
-                  str(len(self._has_nodule_image_list))
-
-        if rotate is True:
-            rotated_images_list = self.rotate_image(self._non_nodule_image_list, rotate_angles=rotate_angles)
-            for images in rotated_images_list:
-                self._non_nodule_image_list += images
-            rotated_images_list = self.rotate_image(self._has_nodule_image_list, rotate_angles=rotate_angles)
-            for images in rotated_images_list:
-                self._has_nodule_image_list += images
-            print "Total images after rotation in non nodule case is " +\
-                  str(len(self._non_nodule_image_list)) +\
-                  " and has nodule case is " +\
-                  str(len(self._has_nodule_image_list))
+        with _stage("augment_images"):
+            if processes > 1:
+                self._non_nodule_image_list, self._has_nodule_image_list = self._augment_in_processes(
+                    [self._non_nodule_image_list, self._has_nodule_image_list],
+                    horizontal_reflection, rotate, rotate_angles, order, processes, cache, self._spill)
+                logger.info("Total images after augmentation in non nodule case is %d and has nodule case is %d",
+                            len(self._non_nodule_image_list), len(self._has_nodule_image_list))
+                self.build_metadata_index()
+                return
+
+            if horizontal_reflection is True:
+                new_non_nodule_image_list = self.horizontally_reflect_images(self._non_nodule_image_list,
+                                                                             cache=cache, spill=self._spill)
+                self._non_nodule_image_list += new_non_nodule_image_list
+                new_has_nodule_image_list = self.horizontally_reflect_images(self._has_nodule_image_list,
+                                                                             cache=cache, spill=self._spill)
+                self._has_nodule_image_list += new_has_nodule_image_list
+                logger.info("Total images after horizontal flip in non nodule case is %d and has nodule case is %d",
+                            len(self._non_nodule_image_list), len(self._has_nodule_image_list))
+
+            if rotate is True:
+                rotated_images_list = self.rotate_image(self._non_nodule_image_list, rotate_angles=rotate_angles,
+                                                        order=order, cache=cache, spill=self._spill)
+                for images in rotated_images_list:
+                    self._non_nodule_image_list += images
+                rotated_images_list = self.rotate_image(self._has_nodule_image_list, rotate_angles=rotate_angles,
+                                                        order=order, cache=cache, spill=self._spill)
+                for images in rotated_images_list:
+                    self._has_nodule_image_list += images
+                logger.info("Total images after rotation in non nodule case is %d and has nodule case is %d",
+                            len(self._non_nodule_image_list), len(self._has_nodule_image_list))
+            self.build_metadata_index()
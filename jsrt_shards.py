@@ -0,0 +1,257 @@
+# -*- coding: utf-8 -*-
+""" Splits the augmentation and saving of the JSRT images into shards that run independently.
+
+A run has three steps:
+    plan  lists every (source image, transform) task in a manifest and deals the source images to N shards.
+    run   augments and saves the images of one or more shards, each into its own file. A shard whose file is already
+          complete (it matches the size and sha1 of its .done record) is skipped, so a run that stopped or a damaged
+          shard can be started again, and shards can run on different machines sharing the output directory.
+    merge checks that every shard file is complete and writes a combined index of all the images.
+
+The images are the ones augment_images gives: every source image, its horizontal reflection and the rotations of
+both. All the tasks of a source image are in the same shard, so the source is read by one worker only. As in
+Jsrt.load_images, the Clinical_Information directory is read from the current directory.
+
+Examples:
+    python jsrt_shards.py plan ./All247images/ manifest.json --shards 8 --rotate-angles 1 2
+    python jsrt_shards.py run manifest.json ./augmented/ --shard 3
+    python jsrt_shards.py run manifest.json ./augmented/ --processes 4
+    python jsrt_shards.py merge manifest.json ./augmented/ --index ./augmented/index.json
+
+"""
+import argparse
+import hashlib
+import json
+import sys
+from multiprocessing import Pool
+from os import getpid, listdir, makedirs, remove, rename
+from os.path import abspath, basename, dirname, exists, getsize, join
+
+sys.path.insert(0, dirname(abspath(__file__)))
+from jsrt import Jsrt  # noqa: E402
+
+EXTENSIONS = {"tfrecords": ".tfrecords", "native": ".jsrt", "packed": ".jsrt"}
+
+
+def plan(images_path, shards, horizontal_reflection=True, rotate_angles=(1, 2), order=3, file_format="tfrecords"):
+    """ This function plans an augmentation run. The source images are sorted by name and dealt in turn to the
+    shards, so the same images and arguments always give the same manifest.
+
+    Args:
+        images_path            (str): path to the directory/folder where all images are present.
+        shards                 (int): Number of shards.
+        horizontal_reflection (bool): Defaults to True. Adds the horizontal reflection of every image.
+        rotate_angles         (list): Defaults to (1, 2). Rotation angles (in degrees) of every image and reflection.
+        order                  (int): Defaults to 3. The order of the spline interpolation used for rotation.
+        file_format            (str): Defaults to "tfrecords". Format of the shard files, see Jsrt.save_images.
+
+    Returns:
+        manifest (dict): The images path, order, file format, number of shards and the tasks as a list of
+                         [source filename, reflect, angle or None, shard].
+
+    """
+    if shards < 1:
+        raise ValueError("Plan: at least one shard is needed")
+    if file_format not in EXTENSIONS:
+        raise ValueError("Plan: unknown file format " + str(file_format))
+    if not images_path.endswith("/"):
+        images_path += "/"
+    sources = sorted(f for f in listdir(images_path) if not f.startswith('.'))
+    reflections = [False, True] if horizontal_reflection is True else [False]
+    tasks = []
+    for index, source in enumerate(sources):
+        for angle in [None] + list(rotate_angles):
+            for reflect in reflections:
+                tasks.append([source, reflect, angle, index % shards])
+    return {"images": images_path, "order": order, "file_format": file_format, "shards": shards, "tasks": tasks}
+
+
+def fingerprint(manifest):
+    """ Gives the sha1 of a manifest, which every shard file is marked with. """
+    return hashlib.sha1(json.dumps(manifest, sort_keys=True)).hexdigest()
+
+
+def shard_filename(manifest, shard):
+    return "shard-%05d-of-%05d%s" % (shard, manifest["shards"], EXTENSIONS[manifest["file_format"]])
+
+
+def _file_sha1(filename):
+    digest = hashlib.sha1()
+    with open(filename, "rb") as shard_file:
+        for block in iter(lambda: shard_file.read(2 ** 20), ""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def _read_done(manifest, output_dir, shard):
+    """ Gives the record of a completed shard, or None if the shard is not complete for this manifest or its file does
+    not match the record (count, size and sha1), so that run_shard makes it again. """
+    done_filename = join(output_dir, shard_filename(manifest, shard) + ".done")
+    if not exists(done_filename):
+        return None
+    with open(done_filename) as done_file:
+        done = json.load(done_file)
+    filename = join(output_dir, done["file"])
+    if done["manifest"] != fingerprint(manifest) or not exists(filename) or getsize(filename) != done["bytes"]:
+        return None
+    if done["count"] != len([task for task in manifest["tasks"] if task[3] == shard]):
+        return None
+    if _file_sha1(filename) != done["sha1"]:
+        return None
+    return done
+
+
+def _atomic_json(data, filename):
+    temporary_filename = filename + ".tmp-%d" % getpid()
+    with open(temporary_filename, "w") as json_file:
+        json.dump(data, json_file, indent=2, sort_keys=True)
+    rename(temporary_filename, filename)
+
+
+def run_shard(manifest, output_dir, shard):
+    """ This function augments the images of one shard and saves them into output_dir/shard-0000k-of-0000N. The file
+    is written under a temporary name and renamed when complete, then a .done file records its size and sha1.
+
+    Args:
+        manifest  (dict): A manifest made by plan.
+        output_dir (str): Directory of the shard files.
+        shard      (int): The shard to run.
+
+    Returns:
+        done (dict): The record of the .done file. When the shard was already complete nothing is written.
+
+    """
+    done = _read_done(manifest, output_dir, shard)
+    if done is not None:
+        return done
+    tasks = [task for task in manifest["tasks"] if task[3] == shard]
+    jsrt = Jsrt().load_images(manifest["images"], lazy=True)
+    images = dict((basename(image.image_path), image)
+                  for image in jsrt._has_nodule_image_list + jsrt._non_nodule_image_list)
+
+    def _augmented():
+        for source, reflect, angle, _ in tasks:
+            new_image = images[source].new_child()
+            if reflect is True:
+                new_image.horizontal_reflection()
+            if angle is not None:
+                new_image.rotate(angle, order=manifest["order"])
+            yield new_image
+
+    filename = shard_filename(manifest, shard)
+    temporary_filename = join(output_dir, filename + ".tmp-%d" % getpid())
+    try:
+        Jsrt.save_images(_augmented(), temporary_filename, file_format=manifest["file_format"])
+        rename(temporary_filename, join(output_dir, filename))
+    finally:
+        if exists(temporary_filename):
+            remove(temporary_filename)
+    done = {"shard": shard, "file": filename, "count": len(tasks), "manifest": fingerprint(manifest),
+            "bytes": getsize(join(output_dir, filename)), "sha1": _file_sha1(join(output_dir, filename))}
+    _atomic_json(done, join(output_dir, filename + ".done"))
+    return done
+
+
+def _run_shard_job(job):
+    """ Process pool worker of run_shards. """
+    manifest, output_dir, shard = job
+    return run_shard(manifest, output_dir, shard)
+
+
+def run_shards(manifest, output_dir, shards=None, processes=1):
+    """ Runs the shards (all of them if None) in a pool of `processes` processes, each shard on its own. """
+    if shards is None:
+        shards = range(manifest["shards"])
+    if not exists(output_dir):
+        makedirs(output_dir)
+    jobs = [(manifest, output_dir, shard) for shard in shards]
+    if processes <= 1:
+        return [_run_shard_job(job) for job in jobs]
+    pool = Pool(processes)
+    try:
+        return pool.map(_run_shard_job, jobs)
+    finally:
+        pool.close()
+        pool.join()
+
+
+def merge(manifest, output_dir):
+    """ This function checks the shard files of a run against their .done records (count, size and sha1) and gives
+    the combined index of the images.
+
+    Args:
+        manifest  (dict): A manifest made by plan.
+        output_dir (str): Directory of the shard files.
+
+    Returns:
+        index, problems (dict, list): index holds the shard files and, for every image, [file index, record index in
+        the file, source filename, reflect, angle]. problems lists the shards that are missing or damaged, the index
+        is only complete when it is empty. Running the shards again makes the missing and damaged ones.
+
+    """
+    files = []
+    records = []
+    problems = []
+    for shard in range(manifest["shards"]):
+        tasks = [task for task in manifest["tasks"] if task[3] == shard]
+        done = _read_done(manifest, output_dir, shard)
+        if done is None:
+            if exists(join(output_dir, shard_filename(manifest, shard) + ".done")):
+                problems.append("shard %d is damaged (%s)" % (shard, shard_filename(manifest, shard)))
+            else:
+                problems.append("shard %d is not complete" % shard)
+            continue
+        records += [[len(files), record, source, reflect, angle]
+                    for record, (source, reflect, angle, _) in enumerate(tasks)]
+        files.append(done["file"])
+    index = {"manifest": fingerprint(manifest), "file_format": manifest["file_format"], "files": files,
+             "records": records}
+    return index, problems
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    commands = parser.add_subparsers(dest="command")
+
+    plan_parser = commands.add_parser("plan", help="write the manifest of a run")
+    plan_parser.add_argument("images", help="directory of the .IMG files")
+    plan_parser.add_argument("manifest", help="manifest file to write")
+    plan_parser.add_argument("--shards", type=int, required=True, help="number of shards")
+    plan_parser.add_argument("--rotate-angles", type=float, nargs="*", default=[1, 2], help="rotation angles")
+    plan_parser.add_argument("--no-reflection", action="store_true", help="do not add horizontal reflections")
+    plan_parser.add_argument("--order", type=int, default=3, help="spline interpolation order of the rotations")
+    plan_parser.add_argument("--format", default="tfrecords", choices=sorted(EXTENSIONS), help="shard file format")
+
+    run_parser = commands.add_parser("run", help="run shards, skipping the complete ones")
+    run_parser.add_argument("manifest", help="manifest file")
+    run_parser.add_argument("output", help="directory of the shard files")
+    run_parser.add_argument("--shard", type=int, nargs="+", default=None, help="shards to run (default: all)")
+    run_parser.add_argument("--processes", type=int, default=1, help="shards run at the same time")
+
+    merge_parser = commands.add_parser("merge", help="verify the shards and write the combined index")
+    merge_parser.add_argument("manifest", help="manifest file")
+    merge_parser.add_argument("output", help="directory of the shard files")
+    merge_parser.add_argument("--index", required=True, help="combined index file to write")
+    args = parser.parse_args()
+
+    if args.command == "plan":
+        manifest = plan(args.images, args.shards, not args.no_reflection, args.rotate_angles, args.order, args.format)
+        _atomic_json(manifest, args.manifest)
+        return
+
+    with open(args.manifest) as manifest_file:
+        manifest = json.load(manifest_file)
+    if args.command == "run":
+        for done in run_shards(manifest, args.output, args.shard, args.processes):
+            sys.stderr.write("shard %d: %d images in %s\n" % (done["shard"], done["count"], done["file"]))
+    else:
+        index, problems = merge(manifest, args.output)
+        for problem in problems:
+            sys.stderr.write(problem + "\n")
+        if problems:
+            sys.exit(1)
+        _atomic_json(index, args.index)
+
+
+if __name__ == "__main__":
+    main()